@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 """
-Define and manage aperture macros (%AM command). Currently,
-only macros without replaceable parameters (e.g., $1, $2, etc.)
-are supported.
+Define and manage aperture macros (%AM command). Macros with
+replaceable parameters (e.g., $1, $2, etc.) are compiled when parsed
+and instantiated into fixed macros for each distinct set of parameters
+used by an aperture definition.
 
 --------------------------------------------------------------------
 
@@ -19,6 +20,9 @@ import string
 import copy
 
 _macro_pat = re.compile(r"^%AM([^*]+)\*$")
+_comment_pat = re.compile(r"^0(?:[ *]|$)")            # Primitive code 0 is a comment
+_assign_pat = re.compile(r"^\$(\d+)=(.+)$")            # Variable definition, e.g., $4=$1x0.5
+_token_pat = re.compile(r"\s*(?:(\d+\.?\d*|\.\d+)|\$(\d+)|([-+xX/()]))")
 
 # This list stores the expected types of parameters for each primitive type
 # (e.g., outline, line, circle, polygon, etc.). None is used for undefined
@@ -30,10 +34,11 @@ _macro_pat = re.compile(r"^%AM([^*]+)\*$")
 # (the parameters are code, exposure type, diameter, X center, Y center).
 # After the integer code, we expect an int for exposure type, then floats
 # for the remaining three parameters. Thus, the entry for code 1 is
-# (int, float, float, float).
+# (int, float, float, float). A circle may also have a rotation, which is the
+# last entry and can be omitted.
 PrimitiveParmTypes = (
     None,                                             # Code 0  -- undefined
-    (int, float, float, float),                       # Code 1  -- circle
+    (int, float, float, float, float),                # Code 1  -- circle...rotation is optional
     (int, float, float, float, float, float, float),  # Code 2  -- line (vector)
     None,                                             # Code 3  -- end-of-file for .DES files
     (int, int, float, float, float, float, float),    # Code 4  -- outline...takes any number of additional floats
@@ -52,7 +57,7 @@ PrimitiveParmTypes = (
     None,                                             # Code 17 -- undefined
     None,                                             # Code 18 -- undefined
     None,                                             # Code 19 -- undefined
-    (int, float, float, float, float, float),         # Code 20 -- line (vector)...alias for code 2
+    (int, float, float, float, float, float, float),  # Code 20 -- line (vector)...alias for code 2
     (int, float, float, float, float, float),         # Code 21 -- line (center)
     (int, float, float, float, float, float)          # Code 22 -- line (lower-left)
 )
@@ -88,12 +93,19 @@ def rotatethelem(L, ix):
 
 
 class ApertureMacroPrimitive:
+    __slots__ = ('code', 'parms')
+
     def __init__(self, code=-1, fields=None):
         self.code = code
         self.parms = []
         if fields is not None:
             self.setFromFields(code, fields)
 
+    def key(self):
+        """Return a hashable canonical form of this primitive. Floating-point
+        parameters are quantized to the 6 decimal places we write out."""
+        return (self.code,) + tuple(p if isinstance(p, int) else int(round(p * 1e6)) for p in self.parms)
+
     def setFromFields(self, code, fields):
         # code is an integer describing the primitive type, and fields is
         # a list of STRINGS for each parameter
@@ -112,12 +124,12 @@ class ApertureMacroPrimitive:
 
         # We expect exactly the number of fields required, except for macro
         # type 4 which is an outline and has a variable number of points.
-        # For outlines, the second parameter indicates the number of points,
-        # each of which has an (X,Y) co-ordinate. Thus, we expect an Outline
-        # specification to have 1+1+2*N+1=3+2N fields:
+        # For outlines, the second parameter indicates the number of points
+        # following the start point, each of which has an (X,Y) co-ordinate.
+        # Thus, we expect an Outline specification to have 1+1+2*(N+1)+1=5+2N fields:
         #   - first field is exposure
-        #   - second field is number of points
-        #   - 2*N fields for X,Y points
+        #   - second field is number of points after the start point
+        #   - 2*(N+1) fields for X,Y points
         #   - last field is rotation
         if self.code == 4:
             if len(fields) < 2:
@@ -128,8 +140,11 @@ class ApertureMacroPrimitive:
             except:
                 raise RuntimeError("Outline macro primitive has non-integer number of points")
 
-            if len(fields) != (3 + 2 * N):
-                raise RuntimeError("Outline macro primitive has {} fields...expecting {} fields".format(len(fields), 3 + 2 * N))
+            if len(fields) != (5 + 2 * N):
+                raise RuntimeError("Outline macro primitive has {} fields...expecting {} fields".format(len(fields), 5 + 2 * N))
+        elif self.code == 1:
+            if len(fields) not in (len(valids) - 1, len(valids)):
+                raise RuntimeError("Circle macro primitive has {} fields...expecting {} or {} fields".format(len(fields), len(valids) - 1, len(valids)))
         else:
             if len(fields) != len(valids):
                 raise RuntimeError("Macro primitive has {} fields...expecting {} fields".format(len(fields), len(valids)))
@@ -168,8 +183,9 @@ class ApertureMacroPrimitive:
             raise
 
     def rotate(self):
-        if self.code == 1:          # Circle: nothing to do
-            pass
+        if self.code == 1:          # Circle: fields (2,3) must be rotated. The optional rotation in field 4
+                                    # is about the origin, so need not be incremented as the center is rotated.
+            rotatexypair(self.parms, 2)
         elif self.code in (2, 20):  # Line (vector): fields (2,3) and (4,5) must be rotated, no need to
                                     # rotate field 6
             rotatexypair(self.parms, 2)
@@ -182,7 +198,7 @@ class ApertureMacroPrimitive:
             rotatethelem(self.parms, 5)
         elif self.code == 4:        # Outline: fields (2,3), (4,5), etc. must be rotated, the last field need not be incremented
             ix = 2
-            for pts in range(self.parms[1]):    # parms[1] is the number of points
+            for pts in range(self.parms[1] + 1):    # parms[1] is the number of points after the start point
                 rotatexypair(self.parms, ix)
                 ix += 2
         elif self.code == 5:      # Polygon: fields (2,3) must be rotated, and field 5 incremented by +90
@@ -213,20 +229,48 @@ class ApertureMacroPrimitive:
         return s
 
     def writeDef(self, fid):
-        fid.write("{:s}*\n".format(self))
+        fid.write("{:s}*\n".format(str(self)))
 
 
 class ApertureMacro:
+    """An aperture macro. Macros hash and compare on a canonical key made
+    from their primitives (not their name), computed once and cached. The
+    primitives must not be changed once the macro has been added to a table."""
+
+    __slots__ = ('name', 'prim', '_key')
+
     def __init__(self, name):
         self.name = name
         self.prim = []
+        self._key = None
+
+    def __getstate__(self):
+        return (self.name, self.prim)
+
+    def __setstate__(self, state):
+        self.name, self.prim = state
+        self._key = None
+
+    @property
+    def key(self):
+        if self._key is None:
+            self._key = tuple(prim.key() for prim in self.prim)
+        return self._key
+
+    def __eq__(self, other):
+        return isinstance(other, ApertureMacro) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def add(self, prim):
         self.prim.append(prim)
+        self._key = None
 
     def rotate(self):
         for prim in self.prim:
             prim.rotate()
+        self._key = None
 
     def rotated(self):
         # Return copy of ourselves, rotated. Replace 'R' as the first letter of the
@@ -242,13 +286,8 @@ class ApertureMacro:
 
     def __str__(self):
         s = "{:s}:\n".format(self.name)
-        s += self.hash()
-        return s
-
-    def hash(self):
-        s = ""
         for prim in self.prim:
-            s += "  {:s}\n".format(prim)
+            s += "  {:s}\n".format(str(prim))
         return s
 
     def writeDef(self, fid):
@@ -258,42 +297,240 @@ class ApertureMacro:
         fid.write("%\n")
 
 
+class _Const:
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, env):
+        return self.value
+
+
+class _Var:
+    __slots__ = ('num',)
+
+    def __init__(self, num):
+        self.num = num
+
+    def evaluate(self, env):
+        try:
+            return env[self.num]
+        except KeyError:
+            raise RuntimeError("Aperture macro variable ${:d} is not defined".format(self.num))
+
+
+class _Neg:
+    __slots__ = ('arg',)
+
+    def __init__(self, arg):
+        self.arg = arg
+
+    def evaluate(self, env):
+        return -self.arg.evaluate(env)
+
+
+class _BinOp:
+    __slots__ = ('op', 'left', 'right')
+
+    Ops = {
+        '+': lambda a, b: a + b,
+        '-': lambda a, b: a - b,
+        'x': lambda a, b: a * b,
+        '/': lambda a, b: a / b
+    }
+
+    def __init__(self, op, left, right):
+        self.op = op
+        self.left = left
+        self.right = right
+
+    def evaluate(self, env):
+        return _BinOp.Ops[self.op](self.left.evaluate(env), self.right.evaluate(env))
+
+
+def _tokenize(expr):
+    tokens = []
+    pos = 0
+    expr = expr.strip()
+    while pos < len(expr):
+        match = _token_pat.match(expr, pos)
+        if not match:
+            raise RuntimeError("Illegal aperture macro expression \"{:s}\"".format(expr))
+        number, var, op = match.groups()
+        if number is not None:
+            tokens.append(('num', float(number)))
+        elif var is not None:
+            tokens.append(('var', int(var)))
+        else:
+            tokens.append(('op', op.lower()))
+        pos = match.end()
+    return tokens
+
+
+def compileExpression(expr):
+    """Compile an aperture macro arithmetic expression (e.g., "$1x0.5+$2")
+    into a tree of nodes with an evaluate(env) method, where env maps
+    variable numbers to values. Constant sub-expressions are folded."""
+    tokens = _tokenize(expr)
+    pos = [0]
+
+    def peek():
+        if pos[0] < len(tokens):
+            return tokens[pos[0]]
+        return (None, None)
+
+    def take():
+        tok = peek()
+        pos[0] += 1
+        return tok
+
+    def fold(node):
+        if isinstance(node, _Neg) and isinstance(node.arg, _Const):
+            return _Const(-node.arg.value)
+        if isinstance(node, _BinOp) and isinstance(node.left, _Const) and isinstance(node.right, _Const):
+            return _Const(node.evaluate(None))
+        return node
+
+    # Grammar: sum := term (('+'|'-') term)*, term := factor (('x'|'/') factor)*,
+    #          factor := ('+'|'-') factor | number | $n | '(' sum ')'
+    def factor():
+        kind, value = take()
+        if kind == 'num':
+            return _Const(value)
+        if kind == 'var':
+            return _Var(value)
+        if (kind, value) == ('op', '-'):
+            return fold(_Neg(factor()))
+        if (kind, value) == ('op', '+'):
+            return factor()
+        if (kind, value) == ('op', '('):
+            node = sum_()
+            if take() != ('op', ')'):
+                raise RuntimeError("Unbalanced parentheses in aperture macro expression \"{:s}\"".format(expr))
+            return node
+        raise RuntimeError("Illegal aperture macro expression \"{:s}\"".format(expr))
+
+    def term():
+        node = factor()
+        while peek() in (('op', 'x'), ('op', '/')):
+            node = fold(_BinOp(take()[1], node, factor()))
+        return node
+
+    def sum_():
+        node = term()
+        while peek() in (('op', '+'), ('op', '-')):
+            node = fold(_BinOp(take()[1], node, term()))
+        return node
+
+    node = sum_()
+    if pos[0] != len(tokens):
+        raise RuntimeError("Illegal aperture macro expression \"{:s}\"".format(expr))
+    return node
+
+
+def _fieldString(value):
+    # Integral values are written without a decimal point so that they can
+    # be converted back for integer fields (exposure, number of points, etc.)
+    if value == int(value):
+        return "{:d}".format(int(value))
+    return repr(value)
+
+
+# Fixed macros instantiated from parametric macros, keyed by (macro key, parameters)
+# so that every aperture using the same parameters shares one instance.
+_instances = {}
+
+
+def clearInstances():
+    "Forget all instantiated macros, which are named after their codes in the GAMT"
+    _instances.clear()
+
+
+class ParametricMacro:
+    """An aperture macro with replaceable parameters ($1, $2, etc.). The body
+    is compiled once when parsed. Fixed ApertureMacro objects are produced by
+    instantiate() for each distinct parameter list and memoized."""
+
+    __slots__ = ('name', 'key', 'statements')
+
+    def __init__(self, name, lines):
+        self.name = name
+        self.key = tuple(lines)
+        self.statements = []     # List of ('$', varnum, expr) or (code, [exprs])
+
+        for line in lines:
+            match = _assign_pat.match(line)
+            if match:
+                self.statements.append(('$', int(match.group(1)), compileExpression(match.group(2))))
+                continue
+
+            fields = line.split(',')
+            try:
+                code = int(fields[0])
+            except:
+                raise RuntimeError("Illegal aperture macro primitive code \"{:s}\"".format(fields[0]))
+            self.statements.append((code, [compileExpression(field) for field in fields[1:]]))
+
+    def instantiate(self, params):
+        """Return a fixed ApertureMacro for the given tuple of parameter values"""
+        params = tuple(params)
+        try:
+            return _instances[self.key, params]
+        except KeyError:
+            pass
+
+        env = dict(zip(range(1, len(params) + 1), params))
+        M = ApertureMacro(self.name)
+        for statement in self.statements:
+            if statement[0] == '$':
+                env[statement[1]] = statement[2].evaluate(env)
+            else:
+                code, exprs = statement
+                M.add(ApertureMacroPrimitive(code, [_fieldString(expr.evaluate(env)) for expr in exprs]))
+
+        _instances[self.key, params] = M
+        return M
+
+
 def parseApertureMacro(s, fid):
     match = _macro_pat.match(s)
     if match:
         name = match.group(1)
 
-        M = ApertureMacro(name)
-
+        # Collect the body of the macro, one statement per line, until the
+        # closing '%' (either on a line by itself or ending the last statement).
+        lines = []
         for line in fid:
-            if line[0] == '%':
-                return M
+            line = line.replace('\x0D', '').strip()
+            done = line.startswith('%') or line.endswith('%')
+            line = line.strip('%').rstrip('*')
+            if line and not _comment_pat.match(line):
+                lines.append(line)
+            if done:
+                break
+        else:
+            raise RuntimeError("Premature end-of-file while parsing aperture macro")
+
+        if any('$' in line for line in lines):
+            return ParametricMacro(name, lines)
 
+        M = ApertureMacro(name)
+        for line in lines:
             P = ApertureMacroPrimitive()
             P.setFromLine(line)
 
             M.add(P)
-        else:
-            raise RuntimeError("Premature end-of-file while parsing aperture macro")
+        return M
     else:
         return None
 
 
 # This function adds the new aperture macro AM to the provided aperture macro
-# table. The return value is the modified macro (name modified to be its global
-# name).  macro.
+# table, a util.CodeTable that tracks the next free M-code. The return value is
+# the modified macro (name modified to be its global name).
 def addToApertureMacroTable(amTable, am):
-    # Must sort keys by integer value, not string since 99 comes before 100
-    # as an integer but not a string.
-    keys = map(int, map(lambda k: k[1:], amTable.keys()))
-    keys.sort()
-
-    if len(keys):
-        lastCode = keys[-1]
-    else:
-        lastCode = 0
-
-    mcode = "M{:d".format(lastCode + 1)
+    mcode = amTable.newCode()
     am.name = mcode
     amTable[mcode] = am
 
@@ -317,7 +554,7 @@ if __name__ == "__main__":
     # A 45-degree line in the third quadrant, not quite touching the origin
     M.add(ApertureMacroPrimitive(22, ('1', '0.02', '0.01', '-0.03', '-0.03', '45')))
     # A right triangle in the second quadrant
-    M.add(ApertureMacroPrimitive(4, ('1', '4', '-0.03', '0.01', '-0.03', '0.03', '-0.01', '0.01', '-0.03', '0.01', '0.0')))
+    M.add(ApertureMacroPrimitive(4, ('1', '3', '-0.03', '0.01', '-0.03', '0.03', '-0.01', '0.01', '-0.03', '0.01', '0.0')))
     # A pentagon in the fourth quadrant, rotated by 15 degrees
     M.add(ApertureMacroPrimitive(5, ('1', '5', '0.03', '-0.03', '0.02', '15')))
     # A moire in the first quadrant, beyond the circle, with 2 annuli
@@ -327,6 +564,35 @@ if __name__ == "__main__":
 
     MR = M.rotated()
 
+    # A circle with the optional rotation keeps it when rotated
+    C = ApertureMacroPrimitive(1, ('1', '0.02', '0.01', '0.0', '30'))
+    C.rotate()
+    assert C.parms == [1, 0.02, 0.0, 0.01, 30.0], C.parms
+
+    # KiCad's rounded rectangle, a parametric macro using code 20 lines with rotation
+    import io
+    RoundRect = """0 Rectangle with rounded corners*
+0 $1 Rounding radius*
+0 $2 $3 $4 $5 $6 $7 $8 $9 X,Y pos of 4 corners*
+4,1,4,$2,$3,$4,$5,$6,$7,$8,$9,$2,$3,0*
+1,1,$1+$1,$2,$3*
+1,1,$1+$1,$4,$5*
+1,1,$1+$1,$6,$7*
+1,1,$1+$1,$8,$9*
+20,1,$1+$1,$2,$3,$4,$5,0*
+20,1,$1+$1,$4,$5,$6,$7,0*
+20,1,$1+$1,$6,$7,$8,$9,0*
+20,1,$1+$1,$8,$9,$2,$3,0*%
+"""
+    PM = parseApertureMacro("%AMRoundRect*", io.StringIO(RoundRect))
+    assert isinstance(PM, ParametricMacro)
+    RR = PM.instantiate((0.01, -0.04, 0.02, 0.04, 0.02, 0.04, -0.02, -0.04, -0.02))
+    assert len(RR.prim) == 9 and RR.prim[5].parms == [1, 0.02, -0.04, 0.02, 0.04, 0.02, 0.0], RR.prim[5].parms
+    RRR = RR.rotated()
+    assert RRR.prim[1].parms == [1, 0.02, -0.02, -0.04], RRR.prim[1].parms
+    assert RRR.prim[5].parms == [1, 0.02, -0.02, -0.04, -0.02, 0.04, 0.0], RRR.prim[5].parms
+    assert RR.prim[5].parms == [1, 0.02, -0.04, 0.02, 0.04, 0.02, 0.0]
+
     # Generate the Gerber so we can view it
     fid = open("amacro.ger", 'wt')
     print("""G75*
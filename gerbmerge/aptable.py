@@ -22,9 +22,9 @@ import util
 # Recognized apertures and re pattern that matches its definition Thermals and
 # annuli are generated using macros (see the eagle.def file) but only on inner
 # layers. Octagons are also generated as macros (%AMOC8) but we handle these
-# specially as the Eagle macro uses a replaceable macro parameter ($1) and
-# GerbMerge doesn't handle these yet...only fixed macros (no parameters) are
-# currently supported.
+# specially so that Eagle octagons are written back out exactly as they came in.
+# Other macros with replaceable parameters ($1, $2, etc.) are instantiated
+# into fixed macros when the aperture that uses them is parsed.
 Apertures = (
     ('Rectangle', re.compile(r"^%AD(D\d+)R,([^X]+)X([^*]+)\*%$"), "%AD{:s}R,{:.5f}X{:.5f}*%\n"),
     ('Circle', re.compile(r"^%AD(D\d+)C,([^*]+)\*%$"), "%AD{:s}C,{:.5f}*%\n"),
@@ -39,21 +39,69 @@ Apertures = (
 #       import aptable
 #       A = aptable.Aperture(aptable.Rectangle, ......)
 
+ApertureTypes = {}
 for ap in Apertures:
     globals()[ap[0]] = ap
+    ApertureTypes[ap[0]] = ap
 
 
 class Aperture:
-    def __init__(self, aptype, code, dimx, dimy=None):
+    """An immutable aperture definition. Apertures are interned: constructing
+    an Aperture with the same type and (quantized) dimensions as an existing
+    one returns the existing object. The canonical key, computed once, is
+    stored in self.key and is also what the object hashes and compares on, so
+    Apertures can be used directly as dictionary keys.
+
+    Apertures do not carry an aperture code. The code is wherever the
+    aperture is stored (e.g., the key in the GAT)."""
+
+    __slots__ = ('apname', 'dimx', 'dimy', 'key')
+
+    # Maps canonical key to the one Aperture object with that key
+    _interned = {}
+
+    def __new__(cls, aptype, dimx, dimy=None):
         assert aptype in Apertures
-        self.apname, self.pat, self.format = aptype
-        self.code = code
-        self.dimx = dimx      # Macro name for Macro apertures
-        self.dimy = dimy      # None for Macro apertures
+        apname = aptype[0]
 
-        if self.apname in ('Circle', 'Octagon', 'Macro'):
+        if apname in ('Circle', 'Octagon', 'Macro'):
             assert (dimy is None)
 
+        # Dimensions are quantized to Gerber 2.5 units, the same resolution as
+        # the aperture definitions we write out. Macro apertures are keyed by
+        # their global macro name.
+        if apname == 'Macro':
+            key = (apname, dimx, None)
+        elif dimy is None:
+            key = (apname, util.in2gerb(dimx), None)
+        else:
+            key = (apname, util.in2gerb(dimx), util.in2gerb(dimy))
+
+        try:
+            return cls._interned[key]
+        except KeyError:
+            pass
+
+        self = object.__new__(cls)
+        object.__setattr__(self, 'apname', apname)
+        object.__setattr__(self, 'dimx', dimx)      # Macro name for Macro apertures
+        object.__setattr__(self, 'dimy', dimy)      # None for Macro apertures
+        object.__setattr__(self, 'key', key)
+        cls._interned[key] = self
+        return self
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Aperture objects are immutable")
+
+    def __reduce__(self):
+        return (Aperture, (ApertureTypes[self.apname], self.dimx, self.dimy))
+
+    def __eq__(self, other):
+        return isinstance(other, Aperture) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
     def isRectangle(self):
         return self.apname == 'Rectangle'
 
@@ -77,6 +125,17 @@ class Aperture:
 
         return (X - xm, Y - ym, X + xp, Y + yp)
 
+    def halfSize(self):
+        """Return (half width, half height) of the area covered by this aperture,
+        rounded up to whole Gerber units. Macro apertures return (0,0) since
+        their size is not known without evaluating the macro."""
+        if self.apname == 'Macro':
+            return (0, 0)
+
+        dx = util.in2gerb(self.dimx)
+        dy = util.in2gerb(self.dimy) if self.dimy else dx
+        return ((dx + 1) // 2, (dy + 1) // 2)
+
     def getAdjusted(self, minimum):
         """
           Adjust aperture properties to conform to minimum feature dimensions
@@ -96,43 +155,34 @@ class Aperture:
                 dimx = self.dimx
             if dimy is None:
                 dimy = self.dimy
-            return Aperture((self.apname, self.pat, self.format), self.code, dimx, dimy)
+            return Aperture(ApertureTypes[self.apname], dimx, dimy)
         else:
             return False  # no new aperture needs to be created
 
-    def rotate(self, GAMT, RevGAMT):
+    def rotated(self, GAMT):
+        """Return the Aperture rotated by 90 degrees counterclockwise. Rectangles
+        and ovals have their dimensions swapped. For macros, the rotated macro
+        is looked up in the GAMT and added to it if not already present."""
         if self.apname in ('Macro',):
-            # Construct a rotated macro, see if it's in the GAMT, and set self.dimx
-            # to its name if so. If not, add the rotated macro to the GAMT and set
-            # self.dimx to the new name. Recall that GAMT maps name to macro
-            # (e.g., GAMT['M9'] = ApertureMacro(...)) while RevGAMT maps hash to
-            # macro name (e.g., RevGAMT[hash] = 'M9')
+            # Construct a rotated macro, see if it's in the GAMT, and use its
+            # name if so. If not, add the rotated macro to the GAMT and use the
+            # new name. Recall that GAMT maps name to macro (e.g., GAMT['M9'] =
+            # ApertureMacro(...)) and can also map a macro back to its name.
             AMR = GAMT[self.dimx].rotated()
-            hash = AMR.hash()
-            try:
-                self.dimx = RevGAMT[hash]
-            except KeyError:
-                AMR = amacro.addToApertureMacroTable(GAMT, AMR)   # adds to GAMT and modifies name to global name
-                self.dimx = RevGAMT[hash] = AMR.name
+            name = GAMT.codeOf(AMR)
+            if name is None:
+                name = amacro.addToApertureMacroTable(GAMT, AMR).name   # adds to GAMT and modifies name to global name
+            return Aperture(Macro, name)
 
         elif self.dimy is not None:       # Rectangles and Ovals have a dimy setting and need to be rotated
-            t = self.dimx
-            self.dimx = self.dimy
-            self.dimy = t
+            return Aperture(ApertureTypes[self.apname], self.dimy, self.dimx)
 
-    def rotated(self, GAMT, RevGAMT):
-        # deepcopy doesn't work on re patterns for some reason so we copy ourselves manually
-        APR = Aperture((self.apname, self.pat, self.format), self.code, self.dimx, self.dimy)
-        APR.rotate(GAMT, RevGAMT)
-        return APR
+        return self
 
     def dump(self, fid=sys.stdout):
         fid.write(str(self))
 
     def __str__(self):
-        return "{:s}: {:s}".format(self.code, self.hash())
-
-    def hash(self):
         if self.dimy:
             return ("{:s} ({:.5f} x {:.5f})".format(self.apname, self.dimx, self.dimy))
         else:
@@ -141,18 +191,25 @@ class Aperture:
             else:
                 return ("{:s} ({:.5f})".format(self.apname, self.dimx))
 
-    def writeDef(self, fid):
+    def writeDef(self, fid, code):
+        "Write the aperture definition to the Gerber file using the given code (e.g., 'D10')"
+        format = ApertureTypes[self.apname][2]
         if self.dimy:
-            fid.write(self.format.format(self.code, self.dimx, self.dimy))
+            fid.write(format.format(code, self.dimx, self.dimy))
         else:
-            fid.write(self.format.format(self.code, self.dimx))
+            fid.write(format.format(code, self.dimx))
 
 
 # Parse the aperture definition in line 's'. macroNames is an aperture macro dictionary
 # that translates macro names local to this file to global names in the GAMT. We make
 # the translation right away so that the return value from this function is an aperture
-# definition with a global macro name, e.g., 'ADD10M5'
-def parseAperture(s, knownMacroNames):
+# definition with a global macro name, e.g., 'ADD10M5'. Macros with replaceable parameters
+# map to an amacro.ParametricMacro instead; these are instantiated with the parameters
+# of the aperture definition (e.g., 'ADD10RoundRect,0.25X1.0X...') and the fixed macro
+# that results is looked up in (or added to) the GAMT. The return value is a 2-tuple
+# (code, Aperture) where code is the aperture code local to the file (e.g., 'D10'),
+# or None if the line is not an aperture definition.
+def parseAperture(s, knownMacroNames, GAMT):
     for ap in Apertures:
         match = ap[1].match(s)
         if match:
@@ -163,10 +220,21 @@ def parseAperture(s, knownMacroNames):
                 code, dimx, dimy = match.groups()
 
             if ap[0] in ('Macro',):
-                if dimx in knownMacroNames:
-                    dimx = knownMacroNames[dimx]    # dimx is now GLOBAL, permanent macro name (e.g., 'M2')
-                else:
-                    raise RuntimeError("Aperture Macro name \"{:s}\" not defined".format(dimx))
+                name, _, parms = dimx.partition(',')
+                if name not in knownMacroNames:
+                    raise RuntimeError("Aperture Macro name \"{:s}\" not defined".format(name))
+
+                dimx = knownMacroNames[name]        # dimx is now GLOBAL, permanent macro name (e.g., 'M2')
+                if isinstance(dimx, amacro.ParametricMacro):
+                    try:
+                        parms = [float(parm) for parm in parms.split('X')] if parms else []
+                    except ValueError:
+                        raise RuntimeError("Illegal aperture macro parameters \"{:s}\"".format(parms))
+
+                    AM = dimx.instantiate(parms)
+                    dimx = GAMT.codeOf(AM)
+                    if dimx is None:
+                        dimx = amacro.addToApertureMacroTable(GAMT, AM).name
             else:
                 try:
                     dimx = float(dimx)
@@ -175,7 +243,7 @@ def parseAperture(s, knownMacroNames):
                 except:
                     raise RuntimeError("Illegal floating point aperture size")
 
-            return Aperture(ap, code, dimx, dimy)
+            return (code, Aperture(ap, dimx, dimy))
 
     return None
 
@@ -187,7 +255,7 @@ def parseAperture(s, knownMacroNames):
 #
 # from a Gerber file would result in the dictionary entry:
 #
-#    "D12": Aperture(ap, 'D10', 0.063, 0.063)
+#    "D12": Aperture(Rectangle, 0.063, 0.063)
 #
 # The input fileList is a list of pathnames which will be read to construct the
 # aperture table for a job.  All the files in the given list will be so
@@ -205,9 +273,13 @@ def constructApertureTable(fileList, GAT, GAMT):
     # we translate from 'THX10N' or whatever to 'M2' right away.
     GAT.clear() # Clear Global Aperture Table
     GAMT.clear() # Clear Global Aperture Macro Table
-    RevGAMT = {}          # Dictionary keyed by aperture macro hash and returning macro name
+    _rotatedCodes.clear()
+
+    # Nothing interned or instantiated for a previous set of jobs carries over
+    Aperture._interned.clear()
+    amacro.clearInstances()
 
-    AT = {}               # Aperture Table for this file
+    AT = {}               # Aperture Table for this file, keyed by Aperture
     for fname in fileList:
 
         knownMacroNames = {}
@@ -230,83 +302,137 @@ def constructApertureTable(fileList, GAT, GAMT):
             AM = amacro.parseApertureMacro(line, fid)
             if AM:
                 # Has this macro definition already been defined (perhaps by another name
-                # in another layer)?
-                try:
-                    # If this macro has already been encountered anywhere in any job,
-                    # RevGAMT will map the macro hash to the global macro name. Then,
-                    # make the local association knownMacroNames[localMacroName] = globalMacroName.
-                    knownMacroNames[AM.name] = RevGAMT[AM.hash()]
-                except KeyError:
+                # in another layer)? If this macro has already been encountered anywhere
+                # in any job, the GAMT will map it to its global macro name. Then,
+                # make the local association knownMacroNames[localMacroName] = globalMacroName.
+                # Macros with parameters are only entered in the GAMT once an aperture
+                # definition instantiates them.
+                if isinstance(AM, amacro.ParametricMacro):
+                    knownMacroNames[AM.name] = AM
+                    continue
+
+                globalMacroName = GAMT.codeOf(AM)
+                if globalMacroName is None:
                     # No, so define the global macro and do the translation. Note that
                     # addToApertureMacroTable() MODIFIES AM.name to the new M-name.
                     localMacroName = AM.name
                     AM = amacro.addToApertureMacroTable(GAMT, AM)
                     knownMacroNames[localMacroName] = AM.name
-                    RevGAMT[AM.hash()] = AM.name
+                else:
+                    knownMacroNames[AM.name] = globalMacroName
             else:
-                A = parseAperture(line, knownMacroNames)
+                A = parseAperture(line, knownMacroNames, GAMT)
 
-                # If this is an aperture definition, add the string representation
-                # to the dictionary. It might already exist.
+                # If this is an aperture definition, add it to the dictionary.
+                # It might already exist.
                 if A:
-                    AT[A.hash()] = A
+                    AT[A[1]] = None
 
         fid.close()
 
-    # Now, go through and assign sequential codes to all apertures
-    code = 11  #start at 11 since we will be using aperture 10 for the overall outline
-    for val in AT.values():
-        key = "D{:d}".format(code)
-        GAT[key] = val
-        val.code = key
-        code += 1
-
-
-def findHighestApertureCode(keys):
-    "Find the highest integer value in a list of aperture codes: ['D10', 'D23', 'D35', ...]"
-
-    # Must sort keys by integer value, not string since 99 comes before 100
-    # as an integer but not a string.
-    keys = [int(K[1:]) for K in keys]
-    keys.sort()
-
-    return keys[-1]
+    # Now, go through and assign sequential codes to all apertures. The GAT
+    # starts at D11 since we will be using aperture 10 for the overall outline.
+    for val in AT.keys():
+        GAT.add(val)
 
 
 def addToApertureTable(AP, GAT):
-    lastCode = findHighestApertureCode(GAT.keys())
-    code = "D{:d}".format(lastCode + 1)
-    GAT[code] = AP
-    AP.code = code
-
-    return code
+    # GAT is a util.CodeTable, which already knows the next free D-code
+    return GAT.add(AP)
 
 
 def findInApertureTable(AP, GAT):
     """Return 'D10', for example in response to query for an object
        of type Aperture()"""
-    hash = AP.hash()
-    for key, val in GAT.items():
-        if hash == val.hash():
-            return key
-
-    return None
+    return GAT.codeOf(AP)
 
 
 def findOrAddAperture(AP, GAT):
-    """If the aperture exists in the GAT, modify the AP.code field to reflect the global code
-    and return the code. Otherwise, create a new aperture in the GAT and return the new code
-    for it."""
-    code = findInApertureTable(AP, GAT)
+    """If the aperture exists in the GAT, return its global code. Otherwise,
+    create a new aperture in the GAT and return the new code for it."""
+    code = GAT.codeOf(AP)
     if code:
-        AP.code = code
         return code
     else:
         return addToApertureTable(AP, GAT)
 
+
+# Global code of each rotated aperture, keyed by (aperture key, degrees). Cleared
+# whenever the GAT is rebuilt.
+_rotatedCodes = {}
+
+
+def findRotatedAperture(AP, degrees, GAT, GAMT):
+    """Return the global code of aperture AP rotated counterclockwise by 'degrees'
+    (a multiple of 90), adding the rotated aperture to the GAT if it doesn't exist
+    yet. Results are cached so each aperture is rotated at most once per angle."""
+    degrees %= 360
+    code = _rotatedCodes.get((AP.key, degrees))
+    if code in GAT:    # Also catches codes removed by consolidateApertures()
+        return code
+
+    APR = AP
+    for rot in range(degrees // 90):
+        APR = APR.rotated(GAMT)
+
+    code = findOrAddAperture(APR, GAT)
+    _rotatedCodes[AP.key, degrees] = code
+    return code
+
+def consolidateApertures(GAT, tolerance):
+    """Merge apertures in the GAT that are within 'tolerance' inches of each other
+    in every dimension. Only apertures of the same type are merged, and macro
+    apertures are never merged. For each group of similar apertures, the one with
+    the lowest code is kept and the others are removed from the GAT. A removed
+    aperture remains known to the GAT as an alias of the one it was merged into,
+    so later lookups of it find the surviving code.
+
+    The return value is a dictionary mapping each removed code to the code that
+    replaces it (e.g., xlat['D37'] = 'D12')."""
+
+    xlat = {}
+    tol = util.in2gerb(tolerance)
+    if tol <= 0:
+        return xlat
+
+    # Apertures are bucketed on a grid of tolerance-sized cells, so candidates
+    # for a merge are found in the 3x3 block of cells around an aperture instead
+    # of by comparison with every other aperture.
+    buckets = {}
+    prefixLen = len(GAT.prefix)
+    for code in sorted(GAT.keys(), key=lambda k: int(k[prefixLen:])):
+        AP = GAT[code]
+        apname, dx, dy = AP.key
+        if apname == 'Macro':
+            continue
+        if dy is None:
+            dy = 0
+
+        bx = dx // tol
+        by = dy // tol
+        for cx in (bx - 1, bx, bx + 1):
+            for cy in (by - 1, by, by + 1):
+                for keepcode, kx, ky in buckets.get((apname, cx, cy), ()):
+                    if abs(kx - dx) <= tol and abs(ky - dy) <= tol:
+                        xlat[code] = keepcode
+                        break
+                if code in xlat:
+                    break
+            if code in xlat:
+                break
+        else:
+            buckets.setdefault((apname, bx, by), []).append((code, dx, dy))
+
+    for code, keepcode in xlat.items():
+        AP = GAT[code]
+        del GAT[code]
+        GAT.alias(AP, keepcode)
+
+    return xlat
+
 if __name__ == "__main__":
-    GAT = {}
-    GAMT = {}
+    GAT = util.CodeTable('D', 11)
+    GAMT = util.CodeTable('M')
     constructApertureTable(sys.argv[1:], GAT, GAMT)
 
     keylist = sorted(GAMT.keys())
@@ -319,4 +445,4 @@ if __name__ == "__main__":
     print("Apertures")
     print("=========")
     for key in keylist:
-        print("{:s}".format(GAT[key]))
+        print("{:s}: {:s}".format(key, GAT[key]))
@@ -19,6 +19,7 @@ import os
 import jobs
 import aptable
 import excellon
+import util
 
 # Configuration dictionary. Specify floats as strings. Ints can be specified
 # as ints or strings.
@@ -34,6 +35,7 @@ Config = {
     'minimumfeaturesize': 0,          # Minimum dimension for selected layers
     'toollist': None,                 # Name of file containing default tool list
     'drillclustertolerance': '.002',  # Tolerance for clustering drill sizes
+    'apertureclustertolerance': 0,    # Tolerance for merging similar apertures, 0 to disable
     'allowmissinglayers': 0,          # Set to 1 to allow multiple jobs to have non-matching layers
     'fabricationdrawingfile': None,   # Name of file to which to write fabrication drawing, or None
     'fabricationdrawingtext': None,   # Name of file containing text to write to fab drawing
@@ -73,15 +75,20 @@ MergeOutputFiles = {
     'toollist': 'merged.toollist.drl'
 }
 
-# The global aperture table, indexed by aperture code (e.g., 'D10')
-GAT = {}
+# The global aperture table, indexed by aperture code (e.g., 'D11'). Codes start
+# at D11 since D10 is reserved for the panel outline.
+GAT = util.CodeTable('D', 11)
 
-# The global aperture macro table, indexed by macro name (e.g., 'M3', 'M4R' for rotated macros)
-GAMT = {}
+# The global aperture macro table, indexed by macro name (e.g., 'M3')
+GAMT = util.CodeTable('M')
 
 # The list of all jobs loaded, indexed by job name (e.g., 'PowerBoard')
 Jobs = {}
 
+# Rotated variants of the jobs above, indexed by (job name, degrees). See
+# jobs.findRotatedJob().
+RotatedJobs = {}
+
 # The set of all Gerber layer names encountered in all jobs. Doesn't
 # include drills.
 LayerList = {'boardoutline': 1}
@@ -108,6 +115,10 @@ TrimGerber = True
 # This configuration option determines whether trimExcellon() is called
 TrimExcellon = True
 
+# This configuration option determines whether trimming is done to the closed
+# outline found on each job's board outline layer rather than to job extents
+TrimOutline = False
+
 # This configuration option determines the minimum size of feature dimensions for
 # each layer. It is a dictionary indexed by layer name (e.g. '*topsilkscreen') and
 # has a floating point number as the value (in inches).
@@ -120,15 +131,6 @@ MinimumFeatureDimension = {}
 SearchTimeout = 0
 
 
-# Construct the reverse-GAT/GAMT translation table, keyed by aperture/aperture macro
-# hash string. The value is the aperture code (e.g., 'D10') or macro name (e.g., 'M5').
-def buildRevDict(D):
-    RevD = {}
-    for key, val in D.items():
-        RevD[val.hash()] = key
-    return RevD
-
-
 def parseStringList(L):
     """Parse something like '*toplayer, *bottomlayer' into a list of names
        without quotes, spaces, etc."""
@@ -267,6 +269,7 @@ def parseConfigFile(configFilePath, Config=Config, Jobs=Jobs):
     # BoardOutline and Drills.
 
     Jobs.clear()
+    RotatedJobs.clear()
 
     do_abort = False
     errstr = 'ERROR'
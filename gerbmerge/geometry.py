@@ -17,6 +17,16 @@ def roundPoint(pt):
     return (int(round(pt[0])), int(round(pt[1])))
 
 
+# This function returns n/d rounded to the nearest integer, halves to even
+# like round(), for integers n and d>0. Being exact, it lets intersection
+# points be rounded once without any floating-point error.
+def roundDiv(n, d):
+    q, r = divmod(n, d)
+    if 2 * r > d or (2 * r == d and q % 2):
+        q += 1
+    return q
+
+
 # Returns True if the segment defined by endpoints p1 and p2 is vertical
 def isSegmentVertical(p1, p2):
     return p1[0] == p2[0]
@@ -222,6 +232,83 @@ def segmentXbox(pt1, pt2, llpt, urpt):
                       # Correct if numPts==0, since it will be empty
 
 
+# Cohen-Sutherland outcodes of a point relative to a rectangle. A point with
+# outcode 0 is inside the rectangle or on its boundary. Two points whose
+# outcodes have a bit in common lie on the same outer side of the rectangle,
+# so the segment joining them cannot cross it.
+OUT_LEFT = 1
+OUT_RIGHT = 2
+OUT_BOTTOM = 4
+OUT_TOP = 8
+
+
+# Return the outcode of (X,Y) point (x,y) relative to the rectangle 'rect',
+# a canonical 4-tuple (minx,miny,maxx,maxy).
+def outcode(x, y, rect):
+    minx, miny, maxx, maxy = rect
+    if x < minx:
+        code = OUT_LEFT
+    elif x > maxx:
+        code = OUT_RIGHT
+    else:
+        code = 0
+
+    if y < miny:
+        code |= OUT_BOTTOM
+    elif y > maxy:
+        code |= OUT_TOP
+
+    return code
+
+
+# This function clips the line segment pt1-->pt2 to the canonical rectangle
+# 'rect' (minx,miny,maxx,maxy), boundary included, using the Liang-Barsky
+# algorithm. The return value is the clipped segment as a pair of points
+# (q1,q2), in the same direction as pt1-->pt2, or None if the segment misses
+# the rectangle. Endpoints that are not clipped are returned unchanged, while
+# new endpoints are computed exactly and then rounded to integer co-ordinates.
+# To do so, the parameters t0 and t1 along the segment are kept as integer
+# fractions t0n/t0d and t1n/t1d with positive denominators.
+# A segment that only touches the rectangle is clipped to a single point,
+# i.e., q1==q2.
+def clipSegment(pt1, pt2, rect):
+    x1, y1 = pt1
+    x2, y2 = pt2
+    dx = x2 - x1
+    dy = y2 - y1
+    minx, miny, maxx, maxy = rect
+
+    t0n, t0d = 0, 1
+    t1n, t1d = 1, 1
+    for p, q in ((-dx, x1 - minx), (dx, maxx - x1), (-dy, y1 - miny), (dy, maxy - y1)):
+        if p == 0:
+            if q < 0:
+                return None     # Parallel to this side and outside of it
+        elif p < 0:
+            # Entering this side at t=q/p
+            if -q * t0d > t0n * -p:
+                t0n, t0d = -q, -p
+        else:
+            # Leaving this side at t=q/p
+            if q * t1d < t1n * p:
+                t1n, t1d = q, p
+
+        if t0n * t1d > t1n * t0d:
+            return None
+
+    if t0n == 0:
+        q1 = pt1
+    else:
+        q1 = (roundDiv(x1 * t0d + t0n * dx, t0d), roundDiv(y1 * t0d + t0n * dy, t0d))
+
+    if t1n == t1d:
+        q2 = pt2
+    else:
+        q2 = (roundDiv(x1 * t1d + t1n * dx, t1d), roundDiv(y1 * t1d + t1n * dy, t1d))
+
+    return (q1, q2)
+
+
 # This function determines if two rectangles defined by 4-tuples
 # (minx, miny, maxx, maxy) have any rectangle in common. If so, it is
 # returned as a 4-tuple, else None is returned. This function assumes
@@ -339,6 +426,26 @@ if __name__ == "__main__":
     assert segmentXbox((1300, 200), (1300, 5200), llpt, urpt) == [(1300, 1000), (1300, 5000)]
     assert segmentXbox((1200, 200), (1300, 5200), llpt, urpt) == [(1216, 1000), (1296, 5000)]
 
+    rect = (1000, 1000, 5000, 5000)
+    assert outcode(3000, 3000, rect) == 0
+    assert outcode(1000, 5000, rect) == 0
+    assert outcode(500, 6000, rect) == OUT_LEFT | OUT_TOP
+    assert outcode(6000, 500, rect) == OUT_RIGHT | OUT_BOTTOM
+
+    assert clipSegment((1500, 2000), (2000, 2500), rect) == ((1500, 2000), (2000, 2500))  # Fully inside
+    assert clipSegment((0, 0), (6000, 6000), rect) == ((1000, 1000), (5000, 5000))        # Through corners
+    assert clipSegment((500, 500), (2500, 2500), rect) == ((1000, 1000), (2500, 2500))    # One point outside
+    assert clipSegment((0, 2000), (900, 6000), rect) is None                              # Misses box
+    assert clipSegment((0, 4000), (2000, 6000), rect) == ((1000, 5000), (1000, 5000))     # Tangent at corner
+    assert clipSegment((1000, 0), (1000, 3000), rect) == ((1000, 1000), (1000, 3000))     # Along box side
+    assert clipSegment((3500, 5500), (3000, 2500), rect) == ((3417, 5000), (3000, 2500))
+    assert clipSegment((500, 3000), (1500, 500), rect) == ((1000, 1750), (1300, 1000))
+    assert clipSegment((2500, 300), (5500, 3500), rect) == ((3156, 1000), (5000, 2967))
+    assert clipSegment((3200, 5200), (-10, 1200), rect) == ((3040, 5000), (1000, 2459))
+    assert clipSegment((1200, 200), (1300, 5200), rect) == ((1216, 1000), (1296, 5000))
+
+    assert roundDiv(7, 2) == 4 and roundDiv(5, 2) == 2 and roundDiv(-5, 2) == -2 and roundDiv(-7, 3) == -2
+
     assert intersectExtents((100, 100, 500, 500), (500, 500, 900, 900)) is None
     assert intersectExtents((100, 100, 500, 500), (400, 400, 900, 900)) == (400, 400, 500, 500)
     assert intersectExtents((100, 100, 500, 500), (200, 0, 600, 300)) == (200, 100, 500, 300)
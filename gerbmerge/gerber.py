@@ -44,7 +44,7 @@ def writeApertures(fid, usedDict):
     keys.sort()
     for key in keys:
         if key in usedDict:
-            config.GAT[key].writeDef(fid)
+            config.GAT[key].writeDef(fid, key)
 
 
 def writeFooter(fid):
@@ -75,8 +75,8 @@ def writeFiducials(fid, drawcode, OriginX, OriginY, MaxXExtent, MaxYExtent):
 
 def writeOutline(fid, OriginX, OriginY, MaxXExtent, MaxYExtent):
     # Write width-1 aperture to file
-    AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
-    AP.writeDef(fid)
+    AP = aptable.Aperture(aptable.Circle, 0.001)
+    AP.writeDef(fid, 'D10')
 
     # Choose drawing aperture D10
     writeCurrentAperture(fid, 10)
@@ -53,6 +53,9 @@ VERSION_MINOR = 0
 
 RANDOM_SEARCH = 1
 EXHAUSTIVE_SEARCH = 2
+SKYLINE_SEARCH = 3
+MAXRECTS_SEARCH = 4
+GUILLOTINE_SEARCH = 5
 config.AutoSearchType = RANDOM_SEARCH
 config.RandomSearchExhaustiveJobs = 2
 
@@ -102,27 +105,38 @@ def disclaimer(ack=False):
 def tile_jobs(Jobs):
     """Take a list of raw Job objects and find best tiling by calling tile_search"""
 
-    # We must take the raw jobs and construct a list of 4-tuples (Xdim,Ydim,job,rjob).
-    # This means we must construct a rotated job for each entry. We first sort all
-    # jobs from largest to smallest. This should give us the best tilings first so
-    # we can interrupt the tiling process and get a decent layout.
+    # We must take the raw jobs and construct a list of 3-tuples (Xdim,Ydim,name),
+    # with dimensions in units of the tiling grid.
+    # The search only deals with these and places each job either as is or
+    # rotated by 90 degrees (though 180 & 270 are available); the rotated jobs
+    # are constructed afterwards for those placed rotated in the final tiling.
+    # We first sort all jobs from largest to smallest. This should give us the
+    # best tilings first so we can interrupt the tiling process and get a decent
+    # layout.
     L = []
     sortJobs = schwartz.schwartz(Jobs, jobs.Job.maxdimension)
     sortJobs.reverse()
 
     for job in sortJobs:
-        Xdim = job.width_in()
-        Ydim = job.height_in()
-        rjob = jobs.rotateJob(job, 90)  # NOTE: This will only try 90 degree rotations though 180 & 270 are available
+        Xdim = job.maxx - job.minx
+        Ydim = job.maxy - job.miny
 
         for count in range(job.Repeat):
-            L.append((Xdim, Ydim, job, rjob))
+            L.append((Xdim, Ydim, job.name))
 
     PX, PY = config.Config['panelwidth'], config.Config['panelheight']
+    X, Y = tiling.toUnits(PX), tiling.toUnits(PY)
+    xspacing, yspacing = tiling.toUnits(config.Config['xspacing']), tiling.toUnits(config.Config['yspacing'])
     if config.AutoSearchType == RANDOM_SEARCH:
-        tile = tile_search_random(L, PX, PY, config.Config['xspacing'], config.Config['yspacing'], config.SearchTimeout, config.RandomSearchExhaustiveJobs)
+        tile = tile_search_random(L, X, Y, xspacing, yspacing, config.SearchTimeout, config.RandomSearchExhaustiveJobs)
+    elif config.AutoSearchType == SKYLINE_SEARCH:
+        tile = tile_search_packing(tilesearch.SkylineSearch, "skyline packing", L, X, Y, xspacing, yspacing)
+    elif config.AutoSearchType == MAXRECTS_SEARCH:
+        tile = tile_search_packing(tilesearch.MaxRectsSearch, "MaxRects packing", L, X, Y, xspacing, yspacing)
+    elif config.AutoSearchType == GUILLOTINE_SEARCH:
+        tile = tile_search_packing(tilesearch.GuillotineSearch, "guillotine packing", L, X, Y, xspacing, yspacing)
     else:
-        tile = tile_search_exhaustive(L, PX, PY, config.Config['xspacing'], config.Config['yspacing'], config.SearchTimeout)
+        tile = tile_search_exhaustive(L, X, Y, xspacing, yspacing, config.SearchTimeout)
 
     if not tile:
         raise RuntimeError('Panel size {:.2f}"x{:.2f}" is too small to hold jobs'.format(PX, PY))
@@ -141,6 +155,12 @@ def merge(opts, gui=None):
 
     if opts.search == 'random':
         config.AutoSearchType = RANDOM_SEARCH
+    elif opts.search == 'skyline':
+        config.AutoSearchType = SKYLINE_SEARCH
+    elif opts.search == 'maxrects':
+        config.AutoSearchType = MAXRECTS_SEARCH
+    elif opts.search == 'guillotine':
+        config.AutoSearchType = GUILLOTINE_SEARCH
     else:
         config.AutoSearchType = EXHAUSTIVE_SEARCH
 
@@ -151,6 +171,8 @@ def merge(opts, gui=None):
         config.TrimGerber = False
     if opts.no_trim_excellon:
         config.TrimExcellon = False
+    if opts.trim_outline:
+        config.TrimOutline = True
 
     config.text = opts.text
     config.text_size = opts.text_size
@@ -185,6 +207,12 @@ def merge(opts, gui=None):
         print("  Size: {:f}\" x {:f}\"".format(job.width_in(), job.height_in()))
         print()
 
+    # Find the board outline polygons to trim to
+    if config.TrimOutline and (config.TrimGerber or config.TrimExcellon):
+        for job in config.Jobs.values():
+            if not job.findOutline():
+                print("Warning: no closed board outline found for job {:s}, trimming to board extents".format(job.name))
+
     # Trim drill locations and flash data to board extents
     if config.TrimExcellon:
         updateGUI("Trimming Excellon data...")
@@ -195,8 +223,26 @@ def merge(opts, gui=None):
     if config.TrimGerber:
         updateGUI("Trimming Gerber data...")
         print("Trimming Gerber data to board outlines ...")
+        tasks = []
+        for job in config.Jobs.values():
+            layers = job.layersToTrim()
+            skipped = [layername for layername in job.commands.keys() if layername not in layers]
+            if skipped:
+                print("  {:s}: layers inside board outline, not trimmed: {:s}".format(job.name, ', '.join(sorted(skipped))))
+            tasks.extend((job, layername) for layername in layers)
+
+        # Each (job, layer) is trimmed independently in a pool of processes
+        jobs.trimGerberLayers(tasks)
+
+    # Merge apertures that only differ by CAD export rounding or trimming
+    if config.Config['apertureclustertolerance'] > 0:
+        updateGUI("Consolidating apertures...")
+        print("Consolidating apertures ...")
+        numApertures = len(config.GAT)
+        xlat = aptable.consolidateApertures(config.GAT, config.Config['apertureclustertolerance'])
         for job in config.Jobs.values():
-            job.trimGerber()
+            job.remapApertures(xlat)
+        print("  Aperture count reduced from {:d} to {:d} ({:d} eliminated)".format(numApertures, len(config.GAT), len(xlat)))
 
     # We start origin at (0.1", 0.1") just so we don't get numbers close to 0
     # which could trip up Excellon leading-0 elimination.
@@ -234,13 +280,13 @@ def merge(opts, gui=None):
     OutputFiles.append(fullname)
 
     # For cut lines
-    AP = aptable.Aperture(aptable.Circle, 'D??', config.Config['cutlinewidth'])
+    AP = aptable.Aperture(aptable.Circle, config.Config['cutlinewidth'])
     drawing_code_cut = aptable.findInApertureTable(AP, config.GAT)
     if drawing_code_cut is None:
         drawing_code_cut = aptable.addToApertureTable(AP, config.GAT)
 
     # For crop marks
-    AP = aptable.Aperture(aptable.Circle, 'D??', config.Config['cropmarkwidth'])
+    AP = aptable.Aperture(aptable.Circle, config.Config['cropmarkwidth'])
     drawing_code_crop = aptable.findInApertureTable(AP, config.GAT)
     if drawing_code_crop is None:
         drawing_code_crop = aptable.addToApertureTable(AP, config.GAT)
@@ -248,11 +294,11 @@ def merge(opts, gui=None):
     # For fiducials
     drawing_code_fiducial_copper = drawing_code_fiducial_soldermask = None
     if config.Config['fiducialpoints']:
-        AP = aptable.Aperture(aptable.Circle, 'D??', config.Config['fiducialcopperdiameter'])
+        AP = aptable.Aperture(aptable.Circle, config.Config['fiducialcopperdiameter'])
         drawing_code_fiducial_copper = aptable.findInApertureTable(AP, config.GAT)
         if drawing_code_fiducial_copper is None:
             drawing_code_fiducial_copper = aptable.addToApertureTable(AP, config.GAT)
-        AP = aptable.Aperture(aptable.Circle, 'D??', config.Config['fiducialmaskdiameter'])
+        AP = aptable.Aperture(aptable.Circle, config.Config['fiducialmaskdiameter'])
         drawing_code_fiducial_soldermask = aptable.findInApertureTable(AP, config.GAT)
         if drawing_code_fiducial_soldermask is None:
             drawing_code_fiducial_soldermask = aptable.addToApertureTable(AP, config.GAT)
@@ -276,13 +322,13 @@ def merge(opts, gui=None):
         text_stroke = max(text_stroke, config.min_text_stroke)
         print("Using text stroke: {0} mils".format(text_stroke))
 
-        AP = aptable.Aperture(aptable.Circle, 'D??', text_stroke / 1000.0)
+        AP = aptable.Aperture(aptable.Circle, text_stroke / 1000.0)
         drawing_code_text = aptable.findInApertureTable(AP, config.GAT)
         if drawing_code_text is None:
             drawing_code_text = aptable.addToApertureTable(AP, config.GAT)
 
     # For fabrication drawing.
-    AP = aptable.Aperture(aptable.Circle, 'D??', 0.001)
+    AP = aptable.Aperture(aptable.Circle, 0.001)
     drawing_code1 = aptable.findInApertureTable(AP, config.GAT)
     if drawing_code1 is None:
         drawing_code1 = aptable.addToApertureTable(AP, config.GAT)
@@ -303,21 +349,25 @@ def merge(opts, gui=None):
         fid = open(fullname, 'wt')
         writeGerberHeader(fid)
 
-        # Determine which apertures and macros are truly needed
+        # Determine which apertures and macros are truly needed. Repeated
+        # instances of a job share the same sets, so only visit each job once.
         apUsedDict = {}
         apmUsedDict = {}
-        for job in Place.jobs:
+        for job in {joblayout.job for joblayout in Place.jobs}:
             apd, apmd = job.aperturesAndMacros(layername)
-            apUsedDict.update(apd)
-            apmUsedDict.update(apmd)
+            apUsedDict.update(dict.fromkeys(apd))
+            apmUsedDict.update(dict.fromkeys(apmd))
 
         # Increase aperature sizes to match minimum feature dimension
         if layername in config.MinimumFeatureDimension:
 
             print("  Thickening", lname, "feature dimensions ...")
 
-            # Fix each aperture used in this layer
-            for ap in list(apUsedDict.keys()):
+            # Fix each aperture used in this layer, collecting the replacements
+            # in a translation map. Apertures are visited in code order so the
+            # codes of newly created apertures don't depend on job order.
+            thicken = {}
+            for ap in sorted(apUsedDict, key=lambda code: int(code[1:])):
                 new = config.GAT[ap].getAdjusted(config.MinimumFeatureDimension[layername])
                 if not new:  # current aperture size met minimum requirement
                     continue
@@ -325,18 +375,12 @@ def merge(opts, gui=None):
                     new_code = aptable.findOrAddAperture(new, config.GAT)  # get name of existing aperture or create new one if needed
                     del apUsedDict[ap]                         # the old aperture is no longer used in this layer
                     apUsedDict[new_code] = None                # the new aperture will be used in this layer
+                    thicken[ap] = new_code
 
-                    # Replace all references to the old aperture with the new one
-                    for joblayout in Place.jobs:
-                        job = joblayout.job  # access job inside job layout
-                        temp = []
-                        if job.hasLayer(layername):
-                            for x in job.commands[layername]:
-                                if x == ap:
-                                    temp.append(new_code)  # replace old aperture with new one
-                                else:
-                                    temp.append(x)         # keep old command
-                            job.commands[layername] = temp
+            # Replace all references to the old apertures with the new ones, once per job
+            if thicken:
+                for job in {joblayout.job for joblayout in Place.jobs}:
+                    job.remapApertures(thicken, layername)
 
         if config.Config['cutlinelayers'] and (layername in config.Config['cutlinelayers']):
             apUsedDict[drawing_code_cut] = None
@@ -410,8 +454,8 @@ def merge(opts, gui=None):
         writeGerberHeader(fid)
 
         # Write width-1 aperture to file
-        AP = aptable.Aperture(aptable.Circle, 'D10', 0.001)
-        AP.writeDef(fid)
+        AP = aptable.Aperture(aptable.Circle, 0.001)
+        AP.writeDef(fid, 'D10')
 
         # Choose drawing aperture D10
         gerber.writeCurrentAperture(fid, 10)
@@ -565,6 +609,14 @@ def tile_search_exhaustive(Jobs, X, Y, xspacing, yspacing, searchTimeout):
 
     search = tilesearch.ExhaustiveSearch(Jobs, X, Y, xspacing, yspacing, searchTimeout)
 
+    # Only look for tilings at least as small as the skyline packing. The
+    # packing only sets the score to beat: it has no corner points, so ties
+    # between tilings must be broken among those found by the search. As
+    # areas are integers, any tiling of the same area beats this score.
+    seed = skyline_seed(Jobs, X, Y, xspacing, yspacing)
+    if seed:
+        search.bestScore = seed.area() + 0.5
+
     possiblePermutations = (2 ** len(Jobs)) * factorial(len(Jobs))
     print('=' * 70)
     print("Starting placement using exhaustive search.")
@@ -584,7 +636,15 @@ def tile_search_exhaustive(Jobs, X, Y, xspacing, yspacing, searchTimeout):
 
     try:
         search.run()
+        interrupted = False
     except KeyboardInterrupt:
+        interrupted = True
+
+    # Use the skyline packing if the search found nothing as small
+    if search.bestTiling is None:
+        search.bestTiling = seed
+
+    if interrupted:
         print(search)
         print()
         print("Interrupted.")
@@ -610,8 +670,10 @@ def tile_search_random(Jobs, X, Y, xspacing, yspacing, searchTimeout, exhaustive
     print("stop the process and use the best placement so far.")
     print("Estimated maximum possible utilization is {:.1f}.".format(tiling.maxUtilization(Jobs, xspacing, yspacing) * 100))
 
-    bestScore = float("inf")
-    bestTiling = None
+    # Start from the skyline packing, which any tiling of the same area or
+    # smaller replaces (as in tile_search_exhaustive(), areas are integers)
+    bestTiling = skyline_seed(Jobs, X, Y, xspacing, yspacing)
+    bestScore = bestTiling.area() + 0.5 if bestTiling else float("inf")
     placementsTried = 0
     startTime = time.time()
     q = multiprocessing.Queue()
@@ -655,6 +717,28 @@ def tile_search_random(Jobs, X, Y, xspacing, yspacing, searchTimeout, exhaustive
     return bestTiling
 
 
+def skyline_seed(Jobs, X, Y, xspacing, yspacing):
+    "Return the best tiling found by skyline packing, or None if no packing fits"
+    search = tilesearch.SkylineSearch(Jobs, X, Y, xspacing, yspacing, 0)
+    search.run()
+    return search.bestTiling
+
+
+def tile_search_packing(searchClass, method, Jobs, X, Y, xspacing, yspacing):
+    """Wrapper around the PackingSearch subclasses"""
+
+    print("=" * 70)
+    print("Starting placement using {:s}.".format(method))
+    print("Estimated maximum possible utilization is {:.1f}%.".format(tiling.maxUtilization(Jobs, xspacing, yspacing) * 100))
+
+    search = searchClass(Jobs, X, Y, xspacing, yspacing, 0)
+    search.run()
+    print(search)
+    print("=" * 70)
+
+    return search.bestTiling
+
+
 def updateGUI(text=None):
     global GUI
     if GUI is not None:
@@ -662,12 +746,13 @@ def updateGUI(text=None):
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Merge gerber files for individual boards into a single panel. Can follow\nmanual layouts or search for optimal arrangements.", epilog="If a layout file is not specified, automatic placement is performed. The layout\nfile can specify either a relative positioning or a manual positioning. A\nmanual positioning layout file is generated by default by this tool.\n\nNOTE: The dimensions of each job are determined solely by the maximum extent\nof the board outline layer for each job.", formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument('--search', choices=['random', 'exhaustive'], default='random', help="Specify search method for automatic layouts. Defaults to random.")
+    parser.add_argument('--search', choices=['random', 'exhaustive', 'skyline', 'maxrects', 'guillotine'], default='random', help="Specify search method for automatic layouts. Defaults to random.")
     parser.add_argument('--version', action='version', version="%(prog)s " + str(VERSION_MAJOR) + "." + str(VERSION_MINOR))
     parser.add_argument('--rs-esjobs', type=int, help="When using random search, exhaustively search N jobs for each random placement. Only matters when using random search. Defaults to 2.", metavar='N', default=2)
     parser.add_argument('--search-timeout', type=int, help="When using random search, search for T seconds for best random placement. Without this option the search will continue until interrupted by user.", metavar='T', default=0)
     parser.add_argument('--no-trim-gerber', action='store_true', help="Do not attempt to trim Gerber data to extents of board")
     parser.add_argument('--no-trim-excellon', action='store_true', help="Do not attempt to trim Excellon  data to extents of board")
+    parser.add_argument('--trim-outline', action='store_true', help="Trim Gerber and Excellon data to the board outline instead of the extents of board")
     parser.add_argument('--octagons', choices=['rotate', 'normal'], default='normal', help="Generate octagons in two different styles depending on the argument. 'rotate' sets rotation to 0 while 'normal' rotates the octagons 22.5deg")
     parser.add_argument('--ack', action='store_true', help="Automatically acknowledge disclaimer/warning")
     parser.add_argument('--text', type=str, help="A string of text to print between boards in layout")
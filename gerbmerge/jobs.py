@@ -12,8 +12,10 @@ Rugged Circuits LLC
 http://ruggedcircuits.com/gerbmerge
 """
 
+import sys
 import re
 import builtins
+import multiprocessing
 
 import aptable
 import config
@@ -22,6 +24,7 @@ import amacro
 import geometry
 import util
 import excellon
+import outline
 
 # Parsing Gerber/Excellon files is currently very brittle. A more robust
 # RS274X/Excellon parser would be a good idea and allow this program to work
@@ -115,7 +118,7 @@ class Job:
 
         # Aperture translation table relative to GAT. This dictionary
         # has as each key a layer name for the job. Each key's value
-        # is itself a dictionary where each key is an aperture in the file.
+        # is itself a util.CodeTable where each key is an aperture in the file.
         # The value is the key in the GAT. Example:
         #       apxlat['TopCopper']['D10'] = 'D12'
         #       apxlat['TopCopper']['D11'] = 'D15'
@@ -148,13 +151,28 @@ class Job:
 
         # This dictionary stores all GLOBAL apertures actually needed by this
         # layer, i.e., apertures specified prior to draw commands.  The dictionary
-        # is indexed by layer name, and each dictionary entry is a list of aperture
+        # is indexed by layer name, and each dictionary entry is a set of aperture
         # code strings, like 'D12'. This dictionary helps us to figure out the
         # minimum number of apertures that need to be written out in the Gerber
-        # header of the merged file. Once again, the list of apertures refers to
+        # header of the merged file. Once again, the set of apertures refers to
         # GLOBAL aperture codes in the GAT, not ones local to this layer.
         self.apertures = {}
 
+        # Likewise, the set of GLOBAL aperture macro names (e.g., 'M2') used by the
+        # apertures of each layer. Both are kept up to date by useAperture().
+        self.macros = {}
+
+        # Bounding box (minx,miny,maxx,maxy) of everything drawn or flashed on
+        # each layer as read from the Gerber file, including the size of the
+        # aperture in use (macro apertures count as their center point only).
+        # This lets trimGerber() skip layers that lie inside the job borders.
+        self.layerExtents = {}
+
+        # The board outline as an outline.OutlinePolygon, if trimming to the
+        # board outline rather than the job's bounding rectangle. Set by
+        # findOutline().
+        self.outline = None
+
         # Excellon commands are grouped by tool number in a dictionary.
         # This is to help sorting all jobs and writing out all plunge
         # commands for a single tool.
@@ -213,6 +231,9 @@ class Job:
         self.miny += y_shift
         self.maxy += y_shift
 
+        for layer, (minx, miny, maxx, maxy) in self.layerExtents.items():
+            self.layerExtents[layer] = (minx + x_shift, miny + y_shift, maxx + x_shift, maxy + y_shift)
+
         # Shift all commands
         for layer, command in self.commands.iteritems():
 
@@ -252,17 +273,15 @@ class Job:
 
         GAT = config.GAT
         GAMT = config.GAMT
-        # First construct reverse GAT/GAMT, mapping definition to code
-        RevGAT = config.buildRevDict(GAT)     # RevGAT[hash] = aperturename
-        RevGAMT = config.buildRevDict(GAMT)   # RevGAMT[hash] = aperturemacroname
 
         fid = open(fullname, 'rt')
         currtool = None
 
-        self.apxlat[layername] = {}
+        self.apxlat[layername] = util.CodeTable('D', 10)
         self.apmxlat[layername] = {}
         self.commands[layername] = []
-        self.apertures[layername] = []
+        self.apertures[layername] = set()
+        self.macros[layername] = set()
 
         # These divisors are used to scale (X,Y) co-ordinates. We store
         # everything as integers in hundred-thousandths of an inch (i.e., M.5
@@ -300,6 +319,11 @@ class Job:
         # to manually insert the point X000000Y00000 into the command stream.
         firstFlash = True
 
+        # Layer extents, and half the size of the current aperture in each direction
+        lminx = lminy = sys.maxsize
+        lmaxx = lmaxy = -sys.maxsize
+        halfx = halfy = 0
+
         for line in fid:
             # Get rid of CR characters (0x0D) and leading/trailing blanks
             line = line.replace('\x0D', '').strip()
@@ -320,17 +344,18 @@ class Job:
                 if currtool:
                     raise RuntimeError("File {:s} has an aperture definition that comes after drawing commands.".format(fullname))
 
-                A = aptable.parseAperture(line, self.apmxlat[layername])
+                A = aptable.parseAperture(line, self.apmxlat[layername], GAMT)
                 if not A:
                     raise RuntimeError("Unknown aperture definition in file {:s}".format(fullname))
 
-                hash = A.hash()
-                if hash not in RevGAT:
-                    raise RuntimeError("File {:s} has aperture definition \"{:s}\" not in global aperture table.".format(fullname, hash))
+                code, A = A
+                globalCode = GAT.codeOf(A)
+                if globalCode is None:
+                    raise RuntimeError("File {:s} has aperture definition \"{:s}\" not in global aperture table.".format(fullname, str(A)))
 
                 # This says that all draw commands with this aperture code will
                 # be replaced by aperture self.apxlat[layername][code].
-                self.apxlat[layername][A.code] = RevGAT[hash]
+                self.apxlat[layername][code] = globalCode
                 continue
 
             # Ignore %AMOC8* from Eagle for now as it uses a macro parameter, which
@@ -344,13 +369,18 @@ class Job:
                 if currtool:
                     raise RuntimeError("File {:s} has an aperture macro definition that comes after drawing commands.".format(fullname))
 
-                hash = M.hash()
-                if hash not in RevGAMT:
-                    raise RuntimeError("File {:s} has aperture macro definition not in global aperture macro table:\n{:s}".format(fullname, hash))
+                # Macros with parameters are instantiated by the aperture definitions that use them
+                if isinstance(M, amacro.ParametricMacro):
+                    self.apmxlat[layername][M.name] = M
+                    continue
+
+                globalName = GAMT.codeOf(M)
+                if globalName is None:
+                    raise RuntimeError("File {:s} has aperture macro definition not in global aperture macro table:\n{:s}".format(fullname, str(M)))
 
                 # This says that all aperture definition commands that reference this macro name
                 # will be replaced by aperture macro name self.apmxlat[layername][macroname].
-                self.apmxlat[layername][M.name] = RevGAMT[hash]
+                self.apmxlat[layername][M.name] = globalName
                 continue
 
             # From this point on we may have more than one match on this line, e.g.:
@@ -452,8 +482,9 @@ class Job:
                     # Add it to the list of things to write out
                     self.commands[layername].append(currtool)
 
-                    # Add it to the list of all apertures needed by this layer
-                    self.apertures[layername].append(currtool)
+                    # Add it to the set of all apertures needed by this layer
+                    self.useAperture(layername, currtool)
+                    halfx, halfy = GAT[currtool].halfSize()
 
                     # Move on to next match, if any
                     sub_line = sub_line[match.end():]
@@ -520,16 +551,30 @@ class Job:
                             self.miny = min(self.miny, 0)
                             self.maxy = max(self.maxy, 0)
 
+                        lminx = min(lminx, 0)
+                        lminy = min(lminy, 0)
+                        lmaxx = max(lmaxx, 0)
+                        lmaxy = max(lmaxy, 0)
+
                     x = int(round(x * x_div))
                     y = int(round(y * y_div))
                     if I is not None:
                         I = int(round(I * x_div))
                         J = int(round(J * y_div))
                         self.commands[layername].append((x, y, I, J, d, circ_signed))
+
+                        # An arc stays within twice its radius of either endpoint
+                        reach = 2 * (abs(I) + abs(J))
                     else:
                         self.commands[layername].append((x, y, d))
+                        reach = 0
                     firstFlash = False
 
+                    lminx = min(lminx, x - halfx - reach)
+                    lminy = min(lminy, y - halfy - reach)
+                    lmaxx = max(lmaxx, x + halfx + reach)
+                    lmaxy = max(lmaxy, y + halfy + reach)
+
                     # Update dimensions...this is complicated for circular interpolation commands
                     # that span more than one quadrant. For now, we ignore this problem since users
                     # should be using a border layer to indicate extents.
@@ -561,6 +606,9 @@ class Job:
 
         fid.close()
 
+        if lminx <= lmaxx:
+            self.layerExtents[layername] = (lminx, lminy, lmaxx, lmaxy)
+
     def parseExcellon(self, fullname):
         fid = open(fullname, 'rt')
         currtool = None
@@ -771,214 +819,119 @@ class Job:
                     makestroke.drawDrillHit(fid, 10 * x + DX, 10 * y + DY, toolNum)
 
     def aperturesAndMacros(self, layername):
-        "Return dictionaries whose keys are all necessary aperture names and macro names for this layer"
+        "Return sets of all necessary aperture names and macro names for this layer"
+        return self.apertures.get(layername, set()), self.macros.get(layername, set())
+
+    def useAperture(self, layername, global_code):
+        "Record that the given global aperture code is used by this layer"
+        self.apertures[layername].add(global_code)
+
+        AP = config.GAT[global_code]
+        if AP.apname == 'Macro':
+            self.macros[layername].add(AP.dimx)
+
+    def remapApertures(self, xlat, layername=None):
+        """Replace global aperture codes according to the dictionary xlat (e.g., xlat['D37'] = 'D12')
+        in the given layer, or in all layers if layername is None"""
+        if layername is None:
+            layers = list(self.commands.keys())
+        elif self.hasLayer(layername):
+            layers = [layername]
+        else:
+            return
 
-        GAT = config.GAT
+        for layername in layers:
+            cmds = self.commands[layername]
+            self.commands[layername] = [xlat.get(cmd, cmd) if isinstance(cmd, str) else cmd for cmd in cmds]
 
-        if layername in self.apertures:
-            apdict = {}.fromkeys(self.apertures[layername])
-            apmlist = [GAT[ap].dimx for ap in self.apertures[layername] if GAT[ap].apname == 'Macro']
-            apmdict = {}.fromkeys(apmlist)
+            used = self.apertures[layername]
+            self.apertures[layername] = set()
+            self.macros[layername] = set()
+            for ap in used:
+                self.useAperture(layername, xlat.get(ap, ap))
 
-            return apdict, apmdict
-        else:
-            return {}, {}
+            table = self.apxlat[layername]
+            for code, global_code in list(table.items()):
+                if global_code in xlat:
+                    table[code] = xlat[global_code]
 
-    def makeLocalApertureCode(self, layername, AP):
-        "Find or create a layer-specific aperture code to represent the global aperture given"
-        if AP.code not in self.apxlat[layername].values():
-            lastCode = aptable.findHighestApertureCode(self.apxlat[layername].keys())
-            localCode = "D{:d}".format(lastCode + 1)
-            self.apxlat[layername][localCode] = AP.code
+    def makeLocalApertureCode(self, layername, global_code):
+        "Find or create a layer-specific aperture code to represent the global aperture code given"
+        if self.apxlat[layername].codeOf(global_code) is None:
+            self.apxlat[layername].add(global_code)
 
     def inBorders(self, x, y):
         return (x >= self.minx) and (x <= self.maxx) and (y >= self.miny) and (y <= self.maxy)
 
     def trimGerberLayer(self, layername):
         "Modify drawing commands that are outside job dimensions"
+        self.setTrimmedLayer(layername, trimCommands(*self.trimArguments(layername)))
 
-        newcmds = []
-        lastInBorders = True
-        lastx, lasty, lastd = self.minx, self.miny, 2   # (minx,miny,exposure off)
-        bordersRect = (self.minx, self.miny, self.maxx, self.maxy)
-        lastAperture = None
+    def trimArguments(self, layername):
+        "Return the arguments to trimCommands() for trimming the given layer"
+        apertures = dict((code, config.GAT[code]) for code in self.apertures[layername])
+        polygon = self.outline if layername != 'boardoutline' else None
+        return (self.commands[layername], (self.minx, self.miny, self.maxx, self.maxy), apertures, polygon)
 
-        for cmd in self.commands[layername]:
-            if isinstance(cmd, tuple):
-                # It is a data command: tuple (X, Y, D), all integers, or (X, Y, I, J, D), all integers.
-                if len(cmd) == 3:
-                    x, y, d = cmd
-                    # I=J=None   # In case we support circular interpolation in the future
-                else:
-                    # We don't do anything with circular interpolation for now, so just issue
-                    # the command and be done with it.
-                    # x, y, I, J, d, s = cmd
-                    newcmds.append(cmd)
-                    continue
-
-                newInBorders = self.inBorders(x, y)
-
-                # Flash commands are easy (for now). If they're outside borders,
-                # ignore them. There's no need to consider the previous command.
-                # What should we do if the flash is partially inside and partially
-                # outside the border? Ideally, define a macro that constructs the
-                # part of the flash that is inside the border. Practically, you've
-                # got to be kidding.
-                #
-                # Actually, it's not that tough for rectangle apertures. We identify
-                # the intersection rectangle of the aperture and the bounding box,
-                # determine the new rectangular aperture required along with the
-                # new flash point, add the aperture to the GAT if necessary, and
-                # make the change. Spiffy.
-                #
-                # For circular interpolation commands, it's definitely harder since
-                # we have to construct arcs that are a subset of the original arc.
-                #
-                # For polygon fills, we similarly have to break up the polygon into
-                # sub-polygons that are contained within the allowable extents.
-                #
-                # Both circular interpolation and polygon fills are a) uncommon,
-                # and b) hard to handle. The current version of GerbMerge does not
-                # handle these cases.
-                if d == 3:
-                    if lastAperture.isRectangle():
-                        apertureRect = lastAperture.rectangleAsRect(x, y)
-                        if geometry.isRect1InRect2(apertureRect, bordersRect):
-                            newcmds.append(cmd)
-                        else:
-                            newRect = geometry.intersectExtents(apertureRect, bordersRect)
-
-                            if newRect:
-                                newRectWidth = geometry.rectWidth(newRect)
-                                newRectHeight = geometry.rectHeight(newRect)
-                                newX, newY = geometry.rectCenter(newRect)
-
-                                # We arbitrarily remove all flashes that lead to rectangles
-                                # with a width or length less than 1 mil (10 Gerber units).
-                                # Should we make this configurable?
-                                if min(newRectWidth, newRectHeight) >= 10:
-                                    # Construct an Aperture that is a Rectangle of dimensions (newRectWidth,newRectHeight)
-                                    newAP = aptable.Aperture(aptable.Rectangle, 'D??', util.gerb2in(newRectWidth), util.gerb2in(newRectHeight))
-                                    global_code = aptable.findOrAddAperture(newAP, config.GAT)
-
-                                    # We need an unused local aperture code to correspond to this newly-created global one.
-                                    self.makeLocalApertureCode(layername, newAP)
-
-                                    # Make sure to indicate that the new aperture is one that is used by this layer
-                                    if global_code not in self.apertures[layername]:
-                                        self.apertures[layername].append(global_code)
-
-                                    # Switch to new aperture code, flash new aperture, switch back to previous aperture code
-                                    newcmds.append(global_code)
-                                    newcmds.append((newX, newY, 3))
-                                    newcmds.append(lastAperture.code)
-                                else:
-                                    pass    # Ignore this flash...area in common is too thin
-                            else:
-                                pass      # Ignore this flash...no area in common
-                    elif self.inBorders(x, y):
-                        # Aperture is not a rectangle and its center is somewhere within our
-                        # borders. Flash it and ignore part outside borders (for now).
-                        newcmds.append(cmd)
-                    else:
-                        pass    # Ignore this flash
+    def setTrimmedLayer(self, layername, cmds):
+        """Replace the commands of a layer with the result of trimCommands(). The
+        new rectangular apertures it created are registered in the GAT here."""
+        newcmds = []
+        for cmd in cmds:
+            if isinstance(cmd, aptable.Aperture):
+                global_code = aptable.findOrAddAperture(cmd, config.GAT)
 
-                # If this is a exposure off command, then it doesn't matter what the
-                # previous command is. This command just updates the (X,Y) position
-                # and sets the start point for a line draw to a new location.
-                elif d == 2:
-                    if self.inBorders(x, y):
-                        newcmds.append(cmd)
+                # We need an unused local aperture code to correspond to this newly-created global one.
+                self.makeLocalApertureCode(layername, global_code)
 
-                else:
-                    # This is an exposure on (draw line) command. Now things get interesting.
-                    # Regardless of what the last command was (draw, exposure off, flash), we
-                    # are planning on drawing a visible line using the current aperture from
-                    # the (lastx,lasty) position to the new (x,y) position. The cases are:
-                    #   A: (lastx,lasty) is outside borders, (x,y) is outside borders.
-                    #      (lastx,lasty) have already been eliminated. Just update (lastx,lasty)
-                    #      with new (x,y) and remove the new command too. There is one case which
-                    #      may be of concern, and that is when the line defined by (lastx,lasty)-(x,y)
-                    #      actually crosses through the job. In this case, we have to draw the
-                    #      partial line (x1,y1)-(x2,y2) where (x1,y1) and (x2,y2) lie on the
-                    #      borders. We will add 3 commands:
-                    #           X(x1)Y(y1)D02   # exposure off
-                    #           X(x2)Y(y2)D01   # exposure on
-                    #           X(x)Y(y)D02     # exposure off
-                    #
-                    #   B: (lastx,lasty) is outside borders, (x,y) is inside borders.
-                    #      We have to find the intersection of the line (lastx,lasty)-(x,y)
-                    #      with the borders and draw only the line segment (x1,y1)-(x,y):
-                    #           X(x1)Y(y1)D02   # exposure off
-                    #           X(x)Y(y)D01     # exposure on
-                    #
-                    #   C: (lastx,lasty) is inside borders, (x,y) is outside borders.
-                    #      We have to find the intersection of the line (lastx,lasty)-(x,y)
-                    #      with the borders and draw only the line segment (lastx,lasty)-(x1,y1):
-                    #      then update to the new position:
-                    #           X(x1)Y(y1)D01   # exposure on
-                    #           X(x)Y(y)D02     # exposure off
-                    #
-                    #   D: (lastx,lasty) is inside borders, (x,y) is inside borders. This is
-                    #      the most common and simplest case...just copy the command over:
-                    #           X(x)Y(y)D01     # exposure on
-                    #
-                    # All of the above are for linear interpolation. Circular interpolation
-                    # is ignored for now.
-                    if lastInBorders and newInBorders:    # Case D
-                        newcmds.append(cmd)
+                # Make sure to indicate that the new aperture is one that is used by this layer
+                self.useAperture(layername, global_code)
+                cmd = global_code
 
-                    else:
-                        # segmentXbox() returns a list of 0, 1, or 2 points describing the intersection
-                        # points of the segment (lastx,lasty)-(x,y) with the box defined
-                        # by lower-left corner (minx,miny) and upper-right corner (maxx,maxy).
-                        pointsL = geometry.segmentXbox((lastx, lasty), (x, y), (self.minx, self.miny), (self.maxx, self.maxy))
-
-                        if len(pointsL) == 0:   # Case A, no intersection
-                            # Both points are outside the box and there is no overlap with box.
-                            d = 2   # Command is effectively removed since newcmds wasn't extended.
-                                    # Ensure "last command" is exposure off to reflect this.
-
-                        elif len(pointsL) == 1:     # Cases B and C
-                            pt1 = pointsL[0]
-                            if newInBorders:      # Case B
-                                newcmds.append((pt1[0], pt1[1], 2))   # Go to intersection point, exposure off
-                                newcmds.append(cmd)                   # Go to destination point, exposure on
-                            else:                 # Case C
-                                newcmds.append((pt1[0], pt1[1], 1))   # Go to intersection point, exposure on
-                                newcmds.append((x, y, 2))             # Go to destination point, exposure off
-                                d = 2                                 # Make next 'lastd' represent exposure off
-
-                        else:                 # Case A, two points of intersection
-                            pt1 = pointsL[0]
-                            pt2 = pointsL[1]
-
-                            newcmds.append((pt1[0], pt1[1], 2))   # Go to first intersection point, exposure off
-                            newcmds.append((pt2[0], pt2[1], 1))   # Draw to second intersection point, exposure on
-                            newcmds.append((x, y, 2))             # Go to destination point, exposure off
-                            d = 2                                 # Make next 'lastd' represent exposure off
-
-                lastx, lasty, lastd = x, y, d
-                lastInBorders = newInBorders
-            else:
-                # It's a string indicating an aperture change, G-code, or RS-274X
-                # command (e.g., "D13", "G75", "%LPD*%")
-                newcmds.append(cmd)
-                if cmd[0] == 'D' and int(cmd[1:]) >= 10:  # Don't interpret D01, D02, D03
-                    lastAperture = config.GAT[cmd]
+            newcmds.append(cmd)
 
         self.commands[layername] = newcmds
 
+    def isLayerInBorders(self, layername):
+        "Return True if everything on the layer is known to lie within job dimensions"
+        try:
+            extents = self.layerExtents[layername]
+        except KeyError:
+            return False
+
+        if not geometry.isRect1InRect2(extents, (self.minx, self.miny, self.maxx, self.maxy)):
+            return False
+        return self.outline is None or layername == 'boardoutline' or self.outline.containsRect(extents)
+
+    def findOutline(self):
+        """Find the closed board outline on the board outline layer, to which
+        trimming is then done instead of the job dimensions. Return False if
+        there is no closed outline, in which case trimming is to the job
+        dimensions as usual."""
+        vertices = outline.extractOutline(self.commands.get('boardoutline', []))
+        self.outline = outline.OutlinePolygon(vertices) if vertices else None
+        return self.outline is not None
+
+    def layersToTrim(self):
+        "Return the names of layers that may have data outside job dimensions"
+        return [layername for layername in self.commands.keys() if not self.isLayerInBorders(layername)]
+
     def trimGerber(self):
-        for layername in self.commands.keys():
+        """Trim all layers to job dimensions. Layers that lie entirely within
+        job dimensions are left alone. Return the list of their names."""
+        layers = self.layersToTrim()
+        for layername in layers:
             self.trimGerberLayer(layername)
 
+        return [layername for layername in self.commands.keys() if layername not in layers]
+
     def trimExcellon(self):
         "Remove plunge commands that are outside job dimensions"
-        keys = self.xcommands.keys()
-        for toolname in keys:
+        for toolname in list(self.xcommands.keys()):
             # Remember Excellon is 2.4 format while Gerber data is 2.5 format
             validList = [(x, y) for x, y in self.xcommands[toolname] if self.inBorders(10 * x, 10 * y)]
+            if self.outline is not None:
+                validList = [(x, y) for x, y in validList if self.outline.contains(10 * x, 10 * y)]
 
             if validList:
                 self.xcommands[toolname] = validList
@@ -1112,178 +1065,414 @@ class JobLayout:
         return self.job.jobarea()
 
 
-def rotateJob(job, degrees=90, firstpass=True):
-    """Create a new job from an existing one, rotating by specified degrees in 90 degree passes"""
-    GAT = config.GAT
-    GAMT = config.GAMT
-    if firstpass:
-        if degrees == 270:
-            J = Job(job.name + "*rotated270")
-        elif degrees == 180:
-            J = Job(job.name + "*rotated180")
+def trimCommands(commands, bordersRect, apertures, polygon=None):
+    """Return a copy of the drawing commands of a layer, modifying those that are
+    outside the job dimensions bordersRect (minx,miny,maxx,maxy), and then those
+    outside the board outline if an outline.OutlinePolygon is given. The dictionary
+    apertures maps the global aperture codes used by the commands to Aperture
+    objects. This function doesn't touch the GAT so it can run in another
+    process: new rectangular apertures for partially trimmed flashes appear
+    in the returned commands as Aperture objects rather than aperture codes
+    (see Job.setTrimmedLayer())."""
+
+    newcmds = []
+    lastOut = 0     # Outcode of last position relative to borders, 0 if inside
+    lastx, lasty, lastd = bordersRect[0], bordersRect[1], 2   # (minx,miny,exposure off)
+    outcode = geometry.outcode
+    lastAperture = None
+    lastCode = None
+
+    for cmd in commands:
+        if isinstance(cmd, tuple):
+            # It is a data command: tuple (X, Y, D), all integers, or (X, Y, I, J, D), all integers.
+            if len(cmd) == 3:
+                x, y, d = cmd
+                # I=J=None   # In case we support circular interpolation in the future
+            else:
+                # We don't do anything with circular interpolation for now, so just issue
+                # the command and be done with it.
+                # x, y, I, J, d, s = cmd
+                newcmds.append(cmd)
+                continue
+
+            newOut = outcode(x, y, bordersRect)
+
+            # Flash commands are easy (for now). If they're outside borders,
+            # ignore them. There's no need to consider the previous command.
+            # What should we do if the flash is partially inside and partially
+            # outside the border? Ideally, define a macro that constructs the
+            # part of the flash that is inside the border. Practically, you've
+            # got to be kidding.
+            #
+            # Actually, it's not that tough for rectangle apertures. We identify
+            # the intersection rectangle of the aperture and the bounding box,
+            # determine the new rectangular aperture required along with the
+            # new flash point, add the aperture to the GAT if necessary, and
+            # make the change. Spiffy.
+            #
+            # For circular interpolation commands, it's definitely harder since
+            # we have to construct arcs that are a subset of the original arc.
+            #
+            # For polygon fills, we similarly have to break up the polygon into
+            # sub-polygons that are contained within the allowable extents.
+            #
+            # Both circular interpolation and polygon fills are a) uncommon,
+            # and b) hard to handle. The current version of GerbMerge does not
+            # handle these cases.
+            if d == 3:
+                if lastAperture.isRectangle():
+                    apertureRect = lastAperture.rectangleAsRect(x, y)
+                    if geometry.isRect1InRect2(apertureRect, bordersRect):
+                        newcmds.append(cmd)
+                    else:
+                        newRect = geometry.intersectExtents(apertureRect, bordersRect)
+
+                        if newRect:
+                            newRectWidth = geometry.rectWidth(newRect)
+                            newRectHeight = geometry.rectHeight(newRect)
+                            newX, newY = geometry.rectCenter(newRect)
+
+                            # We arbitrarily remove all flashes that lead to rectangles
+                            # with a width or length less than 1 mil (10 Gerber units).
+                            # Should we make this configurable?
+                            if min(newRectWidth, newRectHeight) >= 10:
+                                # Construct an Aperture that is a Rectangle of dimensions (newRectWidth,newRectHeight)
+                                newAP = aptable.Aperture(aptable.Rectangle, util.gerb2in(newRectWidth), util.gerb2in(newRectHeight))
+
+                                # Switch to new aperture, flash new aperture, switch back to previous aperture code
+                                newcmds.append(newAP)
+                                newcmds.append((newX, newY, 3))
+                                newcmds.append(lastCode)
+                            else:
+                                pass    # Ignore this flash...area in common is too thin
+                        else:
+                            pass      # Ignore this flash...no area in common
+                elif not newOut:
+                    # Aperture is not a rectangle and its center is somewhere within our
+                    # borders. Flash it and ignore part outside borders (for now).
+                    newcmds.append(cmd)
+                else:
+                    pass    # Ignore this flash
+
+            # If this is a exposure off command, then it doesn't matter what the
+            # previous command is. This command just updates the (X,Y) position
+            # and sets the start point for a line draw to a new location.
+            elif d == 2:
+                if not newOut:
+                    newcmds.append(cmd)
+
+            else:
+                # This is an exposure on (draw line) command. Now things get interesting.
+                # Regardless of what the last command was (draw, exposure off, flash), we
+                # are planning on drawing a visible line using the current aperture from
+                # the (lastx,lasty) position to the new (x,y) position. The cases are:
+                #   A: (lastx,lasty) is outside borders, (x,y) is outside borders.
+                #      (lastx,lasty) have already been eliminated. Just update (lastx,lasty)
+                #      with new (x,y) and remove the new command too. There is one case which
+                #      may be of concern, and that is when the line defined by (lastx,lasty)-(x,y)
+                #      actually crosses through the job. In this case, we have to draw the
+                #      partial line (x1,y1)-(x2,y2) where (x1,y1) and (x2,y2) lie on the
+                #      borders. We will add 3 commands:
+                #           X(x1)Y(y1)D02   # exposure off
+                #           X(x2)Y(y2)D01   # exposure on
+                #           X(x)Y(y)D02     # exposure off
+                #
+                #   B: (lastx,lasty) is outside borders, (x,y) is inside borders.
+                #      We have to find the intersection of the line (lastx,lasty)-(x,y)
+                #      with the borders and draw only the line segment (x1,y1)-(x,y):
+                #           X(x1)Y(y1)D02   # exposure off
+                #           X(x)Y(y)D01     # exposure on
+                #
+                #   C: (lastx,lasty) is inside borders, (x,y) is outside borders.
+                #      We have to find the intersection of the line (lastx,lasty)-(x,y)
+                #      with the borders and draw only the line segment (lastx,lasty)-(x1,y1):
+                #      then update to the new position:
+                #           X(x1)Y(y1)D01   # exposure on
+                #           X(x)Y(y)D02     # exposure off
+                #
+                #   D: (lastx,lasty) is inside borders, (x,y) is inside borders. This is
+                #      the most common and simplest case...just copy the command over:
+                #           X(x)Y(y)D01     # exposure on
+                #
+                # All of the above are for linear interpolation. Circular interpolation
+                # is ignored for now.
+                #
+                # The outcodes of both points settle the common cases without computing
+                # any intersection: both inside is case D, and two points outside on the
+                # same side of the borders can't cross the job (case A).
+                if not (lastOut | newOut):    # Case D
+                    newcmds.append(cmd)
+
+                elif lastOut & newOut:        # Case A, no intersection
+                    d = 2   # Command is effectively removed since newcmds wasn't extended.
+                            # Ensure "last command" is exposure off to reflect this.
+
+                else:
+                    # clipSegment() returns the part (pt1,pt2) of the segment (lastx,lasty)-(x,y)
+                    # inside the borders, or None. Endpoints inside the borders are unchanged.
+                    clipped = geometry.clipSegment((lastx, lasty), (x, y), bordersRect)
+
+                    if clipped is None or clipped[0] == clipped[1]:   # Case A, no intersection
+                        # Both points are outside the box and there is no overlap with box
+                        # (or the segment just touches it).
+                        d = 2
+
+                    else:
+                        pt1, pt2 = clipped
+                        if lastOut:           # Cases A and B
+                            newcmds.append((pt1[0], pt1[1], 2))   # Go to intersection point, exposure off
+
+                        if not newOut:        # Case B
+                            newcmds.append(cmd)                   # Go to destination point, exposure on
+                        else:                 # Cases A and C
+                            newcmds.append((pt2[0], pt2[1], 1))   # Draw to intersection point, exposure on
+                            newcmds.append((x, y, 2))             # Go to destination point, exposure off
+                            d = 2                                 # Make next 'lastd' represent exposure off
+
+            lastx, lasty, lastd = x, y, d
+            lastOut = newOut
         else:
-            J = Job(job.name + "*rotated90")
-    else:
-        J = Job(job.name)
+            # It's a string indicating an aperture change, G-code, or RS-274X
+            # command (e.g., "D13", "G75", "%LPD*%")
+            newcmds.append(cmd)
+            if cmd[0] == 'D' and int(cmd[1:]) >= 10:  # Don't interpret D01, D02, D03
+                lastAperture = apertures[cmd]
+                lastCode = cmd
 
-    # Keep the origin (lower-left) in the same place
-    J.maxx = job.minx + job.maxy - job.miny
-    J.maxy = job.miny + job.maxx - job.minx
-    J.minx = job.minx
-    J.miny = job.miny
+    if polygon is not None:
+        newcmds = outline.trimCommands(newcmds, polygon)
 
-    RevGAT = config.buildRevDict(GAT)    # RevGAT[hash] = aperturename
-    RevGAMT = config.buildRevDict(GAMT)  # RevGAMT[hash] = aperturemacroname
+    return newcmds
 
-    # Keep list of tool diameters and default tool list
-    J.xdiam = job.xdiam
-    J.ToolList = job.ToolList
-    J.Repeat = job.Repeat
 
-    # D-code translation table is the same, except we have to rotate
-    # those apertures which have an orientation: rectangles, ovals, and macros.
+# Total number of commands in the layers to trim from which on a pool of
+# processes is used. Below this, starting the processes and passing the
+# commands to and from them takes longer than trimming serially.
+ParallelTrimCommands = 100000
 
-    ToolChangeReplace = {}
-    for layername in job.apxlat.keys():
-        J.apxlat[layername] = {}
 
-        for ap in job.apxlat[layername].keys():
-            code = job.apxlat[layername][ap]
-            A = GAT[code]
+def _trimTask(args):
+    return trimCommands(*args)
 
-            if A.apname in ('Circle', 'Octagon'):
-            # This aperture is fine. Copy it over.
-                J.apxlat[layername][ap] = code
-                continue
 
-            # Must rotate the aperture
-            APR = A.rotated(config.GAMT, RevGAMT)
+def trimGerberLayers(tasks, processes=None):
+    """Trim the layers given as a list of (job, layername) pairs, spreading the
+    work over a pool of processes if there is enough of it. The results are
+    applied in the order of the tasks, so new apertures get the same codes as
+    when trimming serially."""
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+
+    args = [job.trimArguments(layername) for job, layername in tasks]
+    if processes > 1 and len(tasks) > 1 and sum(len(arg[0]) for arg in args) >= ParallelTrimCommands:
+        pool = multiprocessing.Pool(min(processes, len(tasks)))
+        try:
+            results = pool.map(_trimTask, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [trimCommands(*arg) for arg in args]
+
+    for (job, layername), cmds in zip(tasks, results):
+        job.setTrimmedLayer(layername, cmds)
 
-            # Does it already exist in the GAT?
-            hash = APR.hash()
-            try:
-                # Yup...add it to apxlat
-                newcode = RevGAT[hash]
-            except KeyError:
-                # Must add new aperture to GAT
-                newcode = aptable.addToApertureTable(APR, config.GAT)
-
-                # Rebuild RevGAT
-                #RevGAT = config.buildRevDict(GAT)
-                RevGAT[hash] = newcode
-
-            J.apxlat[layername][ap] = newcode
-
-            # Must also replace all tool change commands from
-            # old code to new command.
-            ToolChangeReplace[code] = newcode
-
-    # Now we copy commands, rotating X,Y positions.
-    # Rotations will occur counterclockwise about the
-    # point (minx,miny). Then, we shift to the right
-    # by the height so that the lower-left point of
-    # the rotated job continues to be (minx,miny).
-    #
-    # We also have to take aperture change commands and
-    # replace them with the new aperture code if we have
-    # a rotation.
-    offset = job.maxy - job.miny
-    for layername in job.commands.keys():
-        J.commands[layername] = []
-        J.apertures[layername] = []
-
-        for cmd in job.commands[layername]:
-            # Is it a drawing command?
-            if isinstance(cmd, tuple):
-                if len(cmd) == 3:
-                    x, y, d = map(builtins.int, cmd)
-                    II = JJ = None
-                else:
-                    x, y, II, JJ, d, signed = map(builtins.int, cmd)   # J is already used as Job object
-            else:
-                # No, must be a string indicating aperture change, G-code, or RS274-X command.
-                if cmd[0] in ('G', '%'):
-                    # G-codes and RS274-X commands are just copied verbatim and not affected by rotation
-                    J.commands[layername].append(cmd)
-                    continue
 
-                # It's a D-code. See if we need to replace aperture changes with a rotated aperture.
-                # But only for D-codes >= 10.
-                if int(cmd[1:]) < 10:
-                    J.commands[layername].append(cmd)
+class RotatedJob(Job):
+    """A view of a job rotated counterclockwise by 90, 180 or 270 degrees. Only the
+    extents are computed up front. The rotated commands, drill hits and aperture
+    usage are built from the source job the first time any of them is needed, so
+    rotated variants that are never placed (e.g., those only considered by the
+    tiling search) cost next to nothing."""
+
+    # Attributes built on demand by rotate()
+    LazyAttributes = ('apxlat', 'commands', 'apertures', 'macros', 'xcommands')
+
+    def __init__(self, job, degrees):
+        Job.__init__(self, "{:s}*rotated{:d}".format(job.name, degrees))
+        for attr in RotatedJob.LazyAttributes:
+            delattr(self, attr)
+
+        self.source = job
+        self.degrees = degrees
+
+        # Keep the origin (lower-left) in the same place. Odd numbers
+        # of 90 degree passes swap the width and height.
+        self.minx = job.minx
+        self.miny = job.miny
+        if degrees in (90, 270):
+            self.maxx = job.minx + job.maxy - job.miny
+            self.maxy = job.miny + job.maxx - job.minx
+        else:
+            self.maxx = job.maxx
+            self.maxy = job.maxy
+
+        # Keep list of tool diameters and default tool list
+        self.xdiam = job.xdiam
+        self.ToolList = job.ToolList
+        self.Repeat = job.Repeat
+        self.ExcellonDecimals = job.ExcellonDecimals
+
+    def __getattr__(self, name):
+        # Only called for attributes not found the normal way
+        if name not in RotatedJob.LazyAttributes:
+            raise AttributeError(name)
+
+        self.rotate()
+        return self.__dict__[name]
+
+    def rotate(self):
+        """Build the rotated layer and drill data from the source job in a single pass.
+        Rotations occur counterclockwise about the point (minx,miny). Then, we shift
+        so that the lower-left point of the rotated job continues to be (minx,miny)."""
+        GAT = config.GAT
+        GAMT = config.GAMT
+        job = self.source
+        degrees = self.degrees
+
+        # D-code translation table is the same, except we have to rotate
+        # those apertures which have an orientation: rectangles, ovals, and macros.
+        apxlat = {}
+        ToolChangeReplace = {}
+        for layername in job.apxlat.keys():
+            apxlat[layername] = util.CodeTable('D', 10)
+
+            for ap in job.apxlat[layername].keys():
+                code = job.apxlat[layername][ap]
+                A = GAT[code]
+
+                if A.apname in ('Circle', 'Octagon'):
+                # This aperture is fine. Copy it over.
+                    apxlat[layername][ap] = code
                     continue
 
-                try:
-                    newcmd = ToolChangeReplace[cmd]
-                    J.commands[layername].append(newcmd)
-                    J.apertures[layername].append(newcmd)
-                except KeyError:
-                    J.commands[layername].append(cmd)
-                    J.apertures[layername].append(cmd)
-                continue
+                # Must rotate the aperture. Find it in the GAT, adding it if it doesn't exist yet
+                newcode = aptable.findRotatedAperture(A, degrees, GAT, GAMT)
+
+                apxlat[layername][ap] = newcode
+
+                # Must also replace all tool change commands from
+                # old code to new command.
+                ToolChangeReplace[code] = newcode
+
+        # Relative to the lower-left corner (u,v) = (X-minx,Y-miny), a job of
+        # width W and height H maps as follows:
+        #     90 degrees:  (u,v) --> (H-v,u)
+        #    180 degrees:  (u,v) --> (W-u,H-v)
+        #    270 degrees:  (u,v) --> (v,W-u)
+        # This is the affine map (X,Y) --> (a*X + b*Y + c, d*X + e*Y + f).
+        minx, miny = job.minx, job.miny
+        W = job.maxx - job.minx
+        H = job.maxy - job.miny
+        a, b, d, e = {90: (0, -1, 1, 0), 180: (-1, 0, 0, -1), 270: (0, 1, -1, 0)}[degrees]
+        if degrees == 90:
+            c, f = minx + miny + H, miny - minx
+        elif degrees == 180:
+            c, f = 2 * minx + W, 2 * miny + H
+        else:
+            c, f = minx - miny, miny + minx + W
+
+        # Now we copy commands, rotating X,Y positions. We also have to take
+        # aperture change commands and replace them with the new aperture code.
+        #
+        # For circular interpolation commands, (I,J) components are always relative
+        # so we do not worry about offsets, just rotate them. For quadrant mode, I/J
+        # are unsigned so only their order changes, for 90 and 270 degrees. For
+        # 360-degree circular interpolation, I/J are signed and map like (X,Y).
+        swapIJ = degrees in (90, 270)
+        commands = {}
+        apertures = {}
+        macros = {}
+        for layername in job.commands.keys():
+            cmds = commands[layername] = []
+            apertures[layername] = set(ToolChangeReplace.get(ap, ap) for ap in job.apertures[layername])
+            macros[layername] = set()
+
+            for cmd in job.commands[layername]:
+                # Is it a drawing command?
+                if isinstance(cmd, tuple):
+                    if len(cmd) == 3:
+                        x, y, D = map(builtins.int, cmd)
+                    else:
+                        x, y, II, JJ, D, signed = map(builtins.int, cmd)   # J is used for jobs elsewhere
 
-            # (X,Y) --> (-Y,X) effects a 90-degree counterclockwise shift
-            # Adding 'offset' to -Y maintains the lower-left origin of (minx,miny).
-            newx = -(y - job.miny) + job.minx + offset
-            newy = (x - job.minx) + job.miny
-
-            # For circular interpolation commands, (I,J) components are always relative
-            # so we do not worry about offsets, just reverse their sense, i.e., I becomes J
-            # and J becomes I. For 360-degree circular interpolation, I/J are signed and we
-            # must map (I,J) --> (-J,I).
-            if II is not None:
-                if signed:
-                    J.commands[layername].append((newx, newy, -JJ, II, d, signed))
+                    newx = a * x + b * y + c
+                    newy = d * x + e * y + f
+                    if len(cmd) == 3:
+                        cmds.append((newx, newy, D))
+                    else:
+                        if signed:
+                            cmds.append((newx, newy, a * II + b * JJ, d * II + e * JJ, D, signed))
+                        elif swapIJ:
+                            cmds.append((newx, newy, JJ, II, D, signed))
+                        else:
+                            cmds.append((newx, newy, II, JJ, D, signed))
                 else:
-                    J.commands[layername].append((newx, newy, JJ, II, d, signed))
-            else:
-                J.commands[layername].append((newx, newy, d))
+                    # No, must be a string indicating aperture change, G-code, or RS274-X command.
+                    # G-codes, RS274-X commands and D-codes below 10 are just copied verbatim and
+                    # not affected by rotation. Aperture changes may need a rotated aperture.
+                    cmds.append(ToolChangeReplace.get(cmd, cmd))
 
-    # Finally, rotate drills. Offset is in hundred-thousandths (2.5) while Excellon
-    # data is in 2.4 format.
-    for tool in job.xcommands.keys():
-        J.xcommands[tool] = []
+            for ap in apertures[layername]:
+                AP = GAT[ap]
+                if AP.apname == 'Macro':
+                    macros[layername].add(AP.dimx)
 
-        for x, y in job.xcommands[tool]:
-            newx = -(10 * y - job.miny) + job.minx + offset
-            newy = (10 * x - job.minx) + job.miny
+        # Finally, rotate drills. Excellon data is in 2.4 format, i.e., in units of
+        # 10 Gerber units. The rotation is exact in Gerber units, after which each
+        # co-ordinate is rounded back to Excellon units exactly once.
+        xcommands = {}
+        for tool in job.xcommands.keys():
+            xcommands[tool] = [(_roundDiv10(10 * (a * x + b * y) + c), _roundDiv10(10 * (d * x + e * y) + f))
+                               for x, y in job.xcommands[tool]]
 
-            newx = int(round(newx / 10.0))
-            newy = int(round(newy / 10.0))
+        self.apxlat = apxlat
+        self.commands = commands
+        self.apertures = apertures
+        self.macros = macros
+        self.xcommands = xcommands
 
-            J.xcommands[tool].append((newx, newy))
 
-    # Rotate some more if required
-    degrees -= 90
-    if degrees > 0:
-        return rotateJob(J, degrees, False)
-    else:
-        return J
+def _roundDiv10(n):
+    "Return integer n / 10 rounded to the nearest integer, ties to even like round()"
+    q, r = divmod(n, 10)
+    if r > 5 or (r == 5 and q % 2):
+        q += 1
+    return q
+
+
+def rotateJob(job, degrees=90):
+    """Create a new job from an existing one, rotating by specified degrees (90, 180 or 270)"""
+    return RotatedJob(job, degrees)
+
+
+def findRotatedJob(job, degrees):
+    """
+      Return the job rotated by the specified degrees (0, 90, 180 or 270).
+      Each rotated job is created once and kept in config.RotatedJobs so
+      that every placement of it shares the same object.
+    """
+    if degrees == 0:
+        return job
+
+    try:
+        return config.RotatedJobs[job.name, degrees]
+    except KeyError:
+        rjob = config.RotatedJobs[job.name, degrees] = rotateJob(job, degrees)
+        return rjob
 
 
 def findJob(jobname, rotated, Jobs):
     """
       Find a job in config.Jobs, possibly rotating it
-      If job not in config.Jobs add it for future reference
       Return found job
     """
-    if rotated == 90:
-        fullname = jobname + "*rotated90"
-    elif rotated == 180:
-        fullname = jobname + "*rotated180"
-    elif rotated == 270:
-        fullname = jobname + "*rotated270"
-    else:
-        fullname = jobname
+    if rotated not in (0, 90, 180, 270):
+        raise RuntimeError("Rotation must be specified in degrees as one of [0, 90, 180, 270].")
 
     try:
-        job = Jobs[existingjob]
-    except:
-        try:
-            job = Jobs[jobname]
-            job = rotateJob(job, rotated)
-            Jobs[fullname] = job
-        except:
-            raise RuntimeError("Job name '{:s}' not found".format(jobname))
+        job = Jobs[jobname]
+    except KeyError:
+        raise RuntimeError("Job name '{:s}' not found".format(jobname))
 
-    return JobLayout(job)
+    return JobLayout(findRotatedJob(job, rotated))
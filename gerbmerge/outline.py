@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+Extract the board outline of a job as a polygon and trim drawing commands
+to it. This is used instead of the job's bounding rectangle for boards that
+are not rectangular (round, L-shaped, etc.)
+
+--------------------------------------------------------------------
+
+This program is licensed under the GNU General Public License (GPL)
+Version 3.  See http://www.fsf.org for details of the license.
+
+Rugged Circuits LLC
+http://ruggedcircuits.com/gerbmerge
+"""
+
+import math
+
+import geometry
+
+# Arcs on the board outline are approximated by straight segments, each of
+# which spans at most this angle (in radians).
+ArcStep = math.pi / 36
+
+
+def cross(ax, ay, bx, by):
+    return ax * by - ay * bx
+
+
+# Return the intermediate points of the arc from 'start' to 'end' drawn with
+# (I,J) offsets, counterclockwise if ccw is True, else clockwise. For signed
+# offsets (multi-quadrant mode) the center is start+(I,J). For unsigned offsets
+# (single-quadrant mode) the signs are chosen so that the center is equidistant
+# from both endpoints.
+def arcPoints(start, end, I, J, signed, ccw):
+    sx, sy = start
+    ex, ey = end
+    if signed:
+        cx, cy = sx + I, sy + J
+    else:
+        centers = [(sx + i, sy + j) for i in (I, -I) for j in (J, -J)]
+        cx, cy = min(centers, key=lambda c: abs(math.hypot(sx - c[0], sy - c[1]) - math.hypot(ex - c[0], ey - c[1])))
+
+    r = math.hypot(sx - cx, sy - cy)
+    a0 = math.atan2(sy - cy, sx - cx)
+    a1 = math.atan2(ey - cy, ex - cx)
+    if ccw:
+        sweep = (a1 - a0) % (2 * math.pi)
+    else:
+        sweep = -((a0 - a1) % (2 * math.pi))
+    if sweep == 0 and signed:
+        sweep = 2 * math.pi if ccw else -2 * math.pi    # Full circle
+    if not signed:
+        sweep = max(-math.pi / 2, min(math.pi / 2, sweep))
+
+    n = int(math.ceil(abs(sweep) / ArcStep))
+    points = []
+    for k in range(1, n):
+        a = a0 + sweep * k / n
+        points.append((int(round(cx + r * math.cos(a))), int(round(cy + r * math.sin(a)))))
+    return points
+
+
+# Find the board outline in the commands of a job's board outline layer. All
+# drawn lines and arcs are collected as edges and chained into closed loops.
+# The loop enclosing the largest area is returned as a list of vertices, or
+# None if the layer contains no closed loop.
+def extractOutline(commands):
+    neighbors = {}
+
+    def addEdge(p, q):
+        if p != q:
+            neighbors.setdefault(p, set()).add(q)
+            neighbors.setdefault(q, set()).add(p)
+
+    pos = None
+    gmode = 1
+    for cmd in commands:
+        if isinstance(cmd, str):
+            if cmd in ('G01', 'G02', 'G03'):
+                gmode = int(cmd[1:])
+            continue
+
+        new = (cmd[0], cmd[1])
+        if cmd[-2 if len(cmd) == 6 else 2] == 1 and pos is not None:
+            if len(cmd) == 6 and gmode in (2, 3):
+                points = [pos] + arcPoints(pos, new, cmd[2], cmd[3], cmd[5], gmode == 3) + [new]
+            else:
+                points = [pos, new]
+            for p, q in zip(points, points[1:]):
+                addEdge(p, q)
+        pos = new
+
+    # Walk the loops formed by vertices that have exactly two neighbors
+    loops = []
+    visited = set()
+    for start in neighbors:
+        if start in visited or len(neighbors[start]) != 2:
+            continue
+
+        loop = [start]
+        visited.add(start)
+        prev, curr = start, next(iter(neighbors[start]))
+        while curr != start:
+            if curr in visited or len(neighbors[curr]) != 2:
+                break
+            loop.append(curr)
+            visited.add(curr)
+            prev, curr = curr, [p for p in neighbors[curr] if p != prev][0]
+        else:
+            if len(loop) >= 3:
+                loops.append(loop)
+
+    if not loops:
+        return None
+
+    return max(loops, key=lambda loop: abs(area(loop)))
+
+
+# Return the signed area of the polygon with the given vertices
+def area(vertices):
+    return sum(cross(p[0], p[1], q[0], q[1]) for p, q in zip(vertices, vertices[1:] + vertices[:1])) / 2.0
+
+
+class OutlinePolygon:
+    """A closed polygon whose edges are held in a uniform grid, so that only the
+    few edges near a point or segment need to be examined. Points on the
+    boundary are considered inside."""
+
+    def __init__(self, vertices):
+        self.edges = list(zip(vertices, vertices[1:] + vertices[:1]))
+
+        xs = [p[0] for p in vertices]
+        ys = [p[1] for p in vertices]
+        self.rect = (min(xs), min(ys), max(xs), max(ys))
+
+        # Roughly sqrt(N) x sqrt(N) cells for N edges
+        cells = max(1, int(math.sqrt(len(self.edges))))
+        self.cellw = max(1, (self.rect[2] - self.rect[0]) // cells + 1)
+        self.cellh = max(1, (self.rect[3] - self.rect[1]) // cells + 1)
+
+        self.grid = {}    # (column, row) --> list of edges overlapping the cell
+        self.rows = {}    # row --> list of edges overlapping the row
+        for edge in self.edges:
+            (x1, y1), (x2, y2) = edge
+            c0, r0 = self.cell(min(x1, x2), min(y1, y2))
+            c1, r1 = self.cell(max(x1, x2), max(y1, y2))
+            for row in range(r0, r1 + 1):
+                self.rows.setdefault(row, []).append(edge)
+                for col in range(c0, c1 + 1):
+                    self.grid.setdefault((col, row), []).append(edge)
+
+    def __getstate__(self):
+        return self.edges
+
+    def __setstate__(self, edges):
+        self.__init__([p for p, q in edges])
+
+    def cell(self, x, y):
+        return (int((x - self.rect[0]) // self.cellw), int((y - self.rect[1]) // self.cellh))
+
+    def edgesNear(self, rect):
+        "Return the set of edges in grid cells overlapping the rectangle (minx,miny,maxx,maxy)"
+        c0, r0 = self.cell(rect[0], rect[1])
+        c1, r1 = self.cell(rect[2], rect[3])
+        edges = set()
+        for row in range(max(r0, 0), r1 + 1):
+            for col in range(max(c0, 0), c1 + 1):
+                edges.update(self.grid.get((col, row), ()))
+        return edges
+
+    def contains(self, x, y):
+        "Return True if point (x,y) is inside the polygon or on its boundary"
+        if not (self.rect[0] <= x <= self.rect[2] and self.rect[1] <= y <= self.rect[3]):
+            return False
+
+        inside = False
+        for (x1, y1), (x2, y2) in self.rows.get(self.cell(x, y)[1], ()):
+            # On this edge?
+            if cross(x2 - x1, y2 - y1, x - x1, y - y1) == 0 and min(x1, x2) <= x <= max(x1, x2) and min(y1, y2) <= y <= max(y1, y2):
+                return True
+
+            # Does a ray from (x,y) to the right cross this edge?
+            if (y1 > y) != (y2 > y):
+                side = cross(x2 - x1, y2 - y1, x - x1, y - y1)
+                if (side > 0) == (y2 > y1):
+                    inside = not inside
+
+        return inside
+
+    def containsRect(self, rect):
+        "Return True if the rectangle (minx,miny,maxx,maxy) is entirely inside the polygon"
+        for p, q in self.edgesNear(rect):
+            if geometry.clipSegment(p, q, rect) is not None:
+                return False
+        return self.contains(rect[0], rect[1])
+
+    def clipSegment(self, pt1, pt2):
+        """Return the list of parts (q1,q2) of the segment pt1-->pt2 that are inside
+        the polygon, in order from pt1 to pt2. Endpoints that are not clipped are
+        returned unchanged, while new endpoints are rounded to integers."""
+        (x1, y1), (x2, y2) = pt1, pt2
+        dx = x2 - x1
+        dy = y2 - y1
+
+        # Parameters (t,n,d) (0<=t<=1) along the segment where it meets an edge,
+        # where t=n/d. The float t orders them and n/d gives the exact point.
+        ts = [(0.0, 0, 1), (1.0, 1, 1)]
+        for (ex1, ey1), (ex2, ey2) in self.edgesNear((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))):
+            sx = ex2 - ex1
+            sy = ey2 - ey1
+            d = cross(dx, dy, sx, sy)
+            if d == 0:
+                # Parallel. If collinear, the edge endpoints split the segment.
+                if cross(ex1 - x1, ey1 - y1, dx, dy) == 0 and (dx or dy):
+                    d = dx * dx + dy * dy
+                    for ex, ey in ((ex1, ey1), (ex2, ey2)):
+                        n = (ex - x1) * dx + (ey - y1) * dy
+                        if 0 <= n <= d:
+                            ts.append((n / d, n, d))
+            else:
+                n = cross(ex1 - x1, ey1 - y1, sx, sy)
+                m = cross(ex1 - x1, ey1 - y1, dx, dy)
+                if d < 0:
+                    n, m, d = -n, -m, -d
+                if 0 <= m <= d and 0 <= n <= d:
+                    ts.append((n / d, n, d))
+
+        # Parameters too close to tell apart as floats give the same point
+        ts.sort()
+        ts = [t for ix, t in enumerate(ts) if ix == 0 or t[0] != ts[ix - 1][0]]
+
+        # Keep the pieces whose midpoints are inside, joining adjacent pieces
+        pieces = []
+        for ta, tb in zip(ts, ts[1:]):
+            tm = (ta[0] + tb[0]) / 2
+            if self.contains(x1 + tm * dx, y1 + tm * dy):
+                if pieces and pieces[-1][1] == ta:
+                    pieces[-1][1] = tb
+                else:
+                    pieces.append([ta, tb])
+
+        def point(t):
+            t, n, d = t
+            if n == 0:
+                return pt1
+            if n == d:
+                return pt2
+            return (geometry.roundDiv(x1 * d + n * dx, d), geometry.roundDiv(y1 * d + n * dy, d))
+
+        return [(point(ta), point(tb)) for ta, tb in pieces]
+
+
+# Return a copy of the drawing commands of a layer, removing everything that
+# is outside the polygon. Flashes are kept if their center is inside the
+# polygon, and drawn lines are clipped to the parts inside it. As with trimming
+# to the job's bounding rectangle, circular interpolation commands are left
+# alone. The position of the "pen" in the output is tracked so that a move
+# is inserted wherever a clipped line doesn't start where the last one ended.
+def trimCommands(commands, polygon):
+    newcmds = []
+    last = None     # Last position in the input
+    pen = None      # Last position in the output
+
+    for cmd in commands:
+        if not isinstance(cmd, tuple):
+            newcmds.append(cmd)
+            continue
+
+        x, y = cmd[0], cmd[1]
+        if len(cmd) == 6:
+            # Arcs are kept whole, but must start from where they did in the input
+            if last is not None and pen != last:
+                newcmds.append((last[0], last[1], 2))
+            newcmds.append(cmd)
+            pen = (x, y)
+        elif cmd[2] != 1 or last is None:
+            # Flash or exposure off: keep if inside
+            if polygon.contains(x, y):
+                newcmds.append(cmd)
+                pen = (x, y)
+        else:
+            for q1, q2 in polygon.clipSegment(last, (x, y)):
+                if q1 != pen:
+                    newcmds.append((q1[0], q1[1], 2))   # Go to start of piece, exposure off
+                if q2 == (x, y):
+                    newcmds.append(cmd)                 # Draw to destination point, exposure on
+                else:
+                    newcmds.append((q2[0], q2[1], 1))   # Draw to end of piece, exposure on
+                pen = q2
+
+        last = (x, y)
+
+    return newcmds
+
+
+if __name__ == "__main__":
+    # An L-shaped board
+    L = OutlinePolygon([(0, 0), (2000, 0), (2000, 1000), (1000, 1000), (1000, 2000), (0, 2000)])
+    assert L.contains(500, 500) and L.contains(500, 1500) and L.contains(1500, 500)
+    assert not L.contains(1500, 1500)
+    assert L.contains(1000, 1500) and L.contains(0, 0) and L.contains(2000, 1000)   # On boundary
+    assert L.containsRect((100, 100, 900, 1900))
+    assert not L.containsRect((100, 100, 1100, 1100))
+
+    assert L.clipSegment((500, 500), (600, 600)) == [((500, 500), (600, 600))]
+    assert L.clipSegment((500, 1500), (2500, 1500)) == [((500, 1500), (1000, 1500))]
+    assert L.clipSegment((-500, 1500), (1500, 1500)) == [((0, 1500), (1000, 1500))]
+    assert L.clipSegment((500, 500), (2500, 2500)) == [((500, 500), (1000, 1000))]
+    assert L.clipSegment((1500, 1500), (1800, 1800)) == []
+    assert L.clipSegment((1500, -500), (1500, 2500)) == [((1500, 0), (1500, 1000))]
+
+    # Pen moves to the start of each piece
+    cmds = trimCommands([(500, 1500, 2), (2500, 1500, 1), (1500, 500, 1)], L)
+    assert cmds == [(500, 1500, 2), (1000, 1500, 1), (2000, 1000, 2), (1500, 500, 1)], cmds
+
+    # Arcs start from their input start point, even if the draw there was clipped
+    cmds = trimCommands([(500, 1500, 2), (2500, 1500, 1), (500, 500, 100, 100, 1, 1)], L)
+    assert cmds == [(500, 1500, 2), (1000, 1500, 1), (2500, 1500, 2), (500, 500, 100, 100, 1, 1)], cmds
+
+    # Outline drawn as separate edges in arbitrary order and direction
+    outline = extractOutline(['G01', (0, 0, 2), (2000, 0, 1), (0, 2000, 2), (0, 0, 1),
+                              (2000, 1000, 2), (2000, 0, 1), (1000, 2000, 2), (0, 2000, 1),
+                              (1000, 1000, 2), (2000, 1000, 1), (1000, 1000, 2), (1000, 2000, 1)])
+    assert abs(area(outline)) == 3000000
+
+    # A circle drawn as a single 360 degree arc
+    circle = extractOutline(['G75', 'G03', (1000, 0, 2), (1000, 0, -1000, 0, 1, 1)])
+    assert len(circle) == 72 and OutlinePolygon(circle).contains(0, 0) and not OutlinePolygon(circle).contains(900, 900)
+
+    print("All tests pass")
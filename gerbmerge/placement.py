@@ -24,6 +24,7 @@ import config
 class Placement:
     def __init__(self):
         self.jobs = []
+        self.cuts = None         # List of score lines (x1,y1,x2,y2) of a guillotine tiling, or None
 
     def addFromTiling(self, t, OriginX, OriginY):
         # t is a Tiling. Calling its canonicalize() method will construct
@@ -31,6 +32,11 @@ class Placement:
         # object.
         self.jobs = self.jobs + t.canonicalize(OriginX, OriginY)
 
+        # A tiling from a guillotine packer also knows the cuts separating its
+        # jobs, which are then the only score lines needed.
+        if t.cuts is not None:
+            self.cuts = t.scoreLines(OriginX, OriginY)
+
     def addFromFile(self, placementFile, OriginX, OriginY):
         # Preprocess the XML jobs file removing lines that start with '#' as those're comment lines.
         # They're not handled by the XML parser, so we remove them beforehand.
@@ -49,7 +55,13 @@ class Placement:
         # Build up the array of rows
         rows = []
         for rowspec in root:
-            if rowspec.tag == 'row':
+            if rowspec.tag == 'cut':
+                # Score lines written out along with a guillotine tiling
+                if self.cuts is None:
+                    self.cuts = []
+                self.cuts.append(parseCutSpec(rowspec))
+                continue
+            elif rowspec.tag == 'row':
                 newRow = parseRowSpec(rowspec, config.Jobs)
             elif rowspec.tag == 'col':
                 newRow = parseColSpec(rowspec, config.Jobs)
@@ -97,6 +109,11 @@ class Placement:
             board.setAttribute('x', str(job.x))
             board.setAttribute('y', str(job.y))
             newpanel.documentElement.appendChild(board)
+        for line in (self.cuts or []):
+            cut = newpanel.createElement('cut')
+            for attr, value in zip(('x1', 'y1', 'x2', 'y2'), line):
+                cut.setAttribute(attr, str(value))
+            newpanel.documentElement.appendChild(cut)
         fid = open(fname, 'wt')
         newpanel.writexml(fid, addindent='\t', newl='\n')
         fid.close()
@@ -245,6 +262,14 @@ def parseJobSpec(spec, globalJobs):
     return job
 
 
+def parseCutSpec(spec):
+    # A score line (x1,y1,x2,y2) in inches, where infinite ends reach the panel edges
+    try:
+        return tuple(float(spec.get(attr)) for attr in ('x1', 'y1', 'x2', 'y2'))
+    except (TypeError, ValueError):
+        raise RuntimeError("Illegal cut (x1='{}',y1='{}',x2='{}',y2='{}') in placement file".format(*[spec.get(attr, '') for attr in ('x1', 'y1', 'x2', 'y2')]))
+
+
 def parseColSpec(spec, globalJobs):
     jobs = Col()
 
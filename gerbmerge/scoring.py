@@ -268,27 +268,37 @@ def mergeLines(Lines):
 # out, 1mil tool selected.
 def writeScoring(fid, Place, OriginX, OriginY, MaxXExtent, MaxYExtent, xspacing, yspacing):
     # For each job, write out 4 score lines, above, to the right, below, and
-    # to the left. After we collect all potential scoring lines, we worry
-    # about merging, etc.
+    # to the left, unless the placement comes with its own cuts. After we
+    # collect all potential scoring lines, we worry about merging, etc.
     dx = xspacing / 2.0
     dy = yspacing / 2.0
     extents = (OriginX, OriginY, MaxXExtent, MaxYExtent)
 
     Lines = []
-    for layout in Place.jobs:
-        x = layout.x - dx
-        y = layout.y - dy
-        X = layout.x + layout.width_in() + dx
-        Y = layout.y + layout.height_in() + dy
-
-        # Just so we don't get 3.75000000004 and 3.75000000009, we round to
-        # 2.5 limits.
-        x, y, X, Y = [round(val, 5) for val in [x, y, X, Y]]
-
-        addHorizontalLine(Lines, OriginX, MaxXExtent, Y, extents)   # above job
-        addVerticalLine(Lines, X, OriginY, MaxYExtent, extents)     # to the right of job
-        addHorizontalLine(Lines, OriginX, MaxXExtent, y, extents)   # below job
-        addVerticalLine(Lines, x, OriginY, MaxYExtent, extents)     # to the left of job
+    if Place.cuts is not None:
+        # The panel was packed to be separated by end-to-end cuts. Score just
+        # those, as lines all across the panel would cut through jobs.
+        for line in Place.cuts:
+            x1, y1, x2, y2 = [round(val, 5) for val in line]
+            if isHorizontal(line):
+                addHorizontalLine(Lines, x1, x2, y1, extents)
+            else:
+                addVerticalLine(Lines, x1, y1, y2, extents)
+    else:
+        for layout in Place.jobs:
+            x = layout.x - dx
+            y = layout.y - dy
+            X = layout.x + layout.width_in() + dx
+            Y = layout.y + layout.height_in() + dy
+
+            # Just so we don't get 3.75000000004 and 3.75000000009, we round to
+            # 2.5 limits.
+            x, y, X, Y = [round(val, 5) for val in [x, y, X, Y]]
+
+            addHorizontalLine(Lines, OriginX, MaxXExtent, Y, extents)   # above job
+            addVerticalLine(Lines, X, OriginY, MaxYExtent, extents)     # to the right of job
+            addHorizontalLine(Lines, OriginX, MaxXExtent, y, extents)   # below job
+            addVerticalLine(Lines, x, OriginY, MaxYExtent, extents)     # to the left of job
 
     # Combine disparate lines into single lines
     Lines = mergeLines(Lines)
@@ -69,8 +69,8 @@ class RandomSearch(TileSearch):
 
     def __str__(self):
         if self.bestTiling:
-            area = self.bestTiling.area()
-            utilization = self.bestTiling.usedArea() / area * 100.0
+            area = self.bestTiling.area() * tiling.Unit ** 2
+            utilization = self.bestTiling.usedArea() / self.bestTiling.area() * 100.0
         else:
             area = float("inf")
             utilization = 0.0
@@ -105,7 +105,7 @@ class RandomSearch(TileSearch):
             minInletSize = tiling.minDimension(self.jobs)
 
             for ix in joborder[:M]:
-                Xdim, Ydim, job, rjob = self.jobs[ix]
+                Xdim, Ydim, name = self.jobs[ix]
 
                 currentTiling.removeInlets(minInletSize)
 
@@ -115,14 +115,14 @@ class RandomSearch(TileSearch):
                         break
 
                     pt = r.choice(addpoints)
-                    currentTiling.addJob(pt, Xdim + self.xspacing, Ydim + self.yspacing, job)
+                    currentTiling.addJob(pt, Xdim + self.xspacing, Ydim + self.yspacing, name)
                 else:
                     addpoints = currentTiling.validAddPoints(Ydim + self.xspacing, Xdim + self.yspacing)
                     if not addpoints:
                         break
 
                     pt = r.choice(addpoints)
-                    currentTiling.addJob(pt, Ydim + self.xspacing, Xdim + self.yspacing, rjob)
+                    currentTiling.addJob(pt, Ydim + self.xspacing, Xdim + self.yspacing, name, 90)
             else:
                 # Do exhaustive search on remaining jobs
                 if N - M:
@@ -186,8 +186,8 @@ class ExhaustiveSearch(TileSearch):
 
     def __str__(self):
         if self.bestTiling:
-            area = self.bestTiling.area()
-            utilization = self.bestTiling.usedArea() / area * 100.0
+            area = self.bestTiling.area() * tiling.Unit ** 2
+            utilization = self.bestTiling.usedArea() / self.bestTiling.area() * 100.0
         else:
             area = float("inf")
             utilization = 0.0
@@ -207,24 +207,23 @@ class ExhaustiveSearch(TileSearch):
     def _run(self, Jobs, tiles, firstAddPoint, printStats):
         """This recursive function does the following with an existing tiling baseTiling:
 
-           * For each 4-tuple (Xdim,Ydim,job,rjob) in Jobs, the non-rotated 'job' is selected
+           * For each 3-tuple (Xdim,Ydim,name) in Jobs, the non-rotated job is selected
 
            * For the non-rotated job, the list of valid add-points is found
 
-           * For each valid add-point, the job is placed at this point in a new,
-             cloned tiling.
+           * For each valid add-point, the job is pushed onto the tiling at this
+             point.
 
            * The function then calls its recursively with the remaining list of
-             jobs.
+             jobs, and pops the job off the tiling again.
 
            * The rotated job is then selected and the list of valid add-points is
-             found. Again, for each valid add-point the job is placed there in
-             a new, cloned tiling.
+             found. Again, for each valid add-point the job is pushed there.
 
            * Once again, the function calls itself recursively with the remaining
              list of jobs.
 
-           * The best tiling encountered from all recursive calls is returned.
+           * A copy of the best tiling encountered from all recursive calls is kept.
 
            If baseTiling is None it means this combination of jobs is not tileable.
 
@@ -242,7 +241,7 @@ class ExhaustiveSearch(TileSearch):
             score = tiles.area()
 
             if score < self.bestScore or (score == self.bestScore and tiles.corners() < self.bestTiling.corners()):
-                self.bestTiling = tiles
+                self.bestTiling = tiles.clone()
                 self.bestScore = score
 
             if firstAddPoint:
@@ -255,7 +254,7 @@ class ExhaustiveSearch(TileSearch):
         for job_ix in range(len(Jobs)):
             # Pop off the next job and construct remaining_jobs, a sub-list
             # of Jobs with the job we've just popped off excluded.
-            Xdim, Ydim, job, rjob = Jobs[job_ix]
+            Xdim, Ydim, name = Jobs[job_ix]
             remaining_jobs = Jobs[:job_ix] + Jobs[job_ix + 1:]
 
             # Construct add-points for the non-rotated and rotated job.
@@ -271,18 +270,17 @@ class ExhaustiveSearch(TileSearch):
             # update the best-tiling-so-far as we do so.
             if addpoints1:
                 for ix in addpoints1:
-                    # Clone the tiling we're starting with and add the job at this
-                    # add-point.
-                    T = tiles.clone()
-                    T.addJob(ix, Xdim + self.xspacing, Ydim + self.yspacing, job)
+                    # Add the job to the tiling at this add-point.
+                    tiles.push(ix, Xdim + self.xspacing, Ydim + self.yspacing, name)
 
-                    # Recursive call with the remaining jobs and this new tiling. The
+                    # Recursive call with the remaining jobs and the job added. The
                     # point behind the last parameter is simply so that self.permutations is
                     # only updated once for each permutation, not once per add-point.
                     # A permutation is some ordering of jobs (N! choices) and some
                     # ordering of non-rotated and rotated within that ordering (2**N
                     # possibilities per ordering).
-                    self._run(remaining_jobs, T, firstAddPoint and ix == addpoints1[0], printStats)
+                    self._run(remaining_jobs, tiles, firstAddPoint and ix == addpoints1[0], printStats)
+                    tiles.pop()
             elif firstAddPoint:
                 # Premature prune due to not being able to put this job anywhere. We
                 # have pruned off 2^M permutations where M is the length of the remaining
@@ -291,14 +289,13 @@ class ExhaustiveSearch(TileSearch):
 
             if addpoints2:
                 for ix in addpoints2:
-                    # Clone the tiling we're starting with and add the job at this
-                    # add-point. Remember that the job is rotated so swap X and Y
-                    # dimensions.
-                    T = tiles.clone()
-                    T.addJob(ix, Ydim + self.xspacing, Xdim + self.yspacing, rjob)
-
-                    # Recursive call with the remaining jobs and this new tiling.
-                    self._run(remaining_jobs, T, firstAddPoint and ix == addpoints2[0], printStats)
+                    # Add the job to the tiling at this add-point. Remember that
+                    # the job is rotated so swap X and Y dimensions.
+                    tiles.push(ix, Ydim + self.xspacing, Xdim + self.yspacing, name, 90)
+
+                    # Recursive call with the remaining jobs and the job added.
+                    self._run(remaining_jobs, tiles, firstAddPoint and ix == addpoints2[0], printStats)
+                    tiles.pop()
             elif firstAddPoint:
                 # Premature prune due to not being able to put this job anywhere. We
                 # have pruned off 2^M permutations where M is the length of the remaining
@@ -313,3 +310,477 @@ class ExhaustiveSearch(TileSearch):
                 # Check for timeout
                 if (self.searchTimeout > 0) and ((time.time() - self.startTime) > self.searchTimeout):
                     return
+
+
+class PackingSearch(TileSearch):
+    """Base class of deterministic packers. Jobs are placed one at a time, in
+    either orientation, at the best position found by the packer's rule. This
+    is repeated for several orderings of the jobs, several strip widths and each
+    rule of the packer, and the tiling with the smallest area is kept. Packers
+    take well under a second. Subclasses define Rules, the list of rules to
+    try, and pack(jobs,width,rule), which packs the list of jobs in the given
+    order into a strip of the given width and the height of the panel and
+    returns the Tiling, or None if they don't fit."""
+
+    # Orderings of jobs, largest first by each of these measures
+    Orders = (lambda job: job[0] * job[1],     # Area
+              lambda job: max(job[0], job[1]),  # Longest side
+              lambda job: job[0] + job[1])      # Perimeter
+
+    # Strip widths to try, as multiples of the side of a square of the total
+    # area of all jobs. The panel width is always tried as well.
+    WidthFactors = (0.75, 1.0, 1.25, 1.5, 2.0)
+
+    Rules = ()
+
+    def __str__(self):
+        if self.bestTiling:
+            area = self.bestTiling.area() * tiling.Unit ** 2
+            utilization = self.bestTiling.usedArea() / self.bestTiling.area() * 100.0
+            return "\n  {:d} packings | Smallest area: {:.1f} sq. in. | Best utilization: {:.1f}%".format(self.placements, area, utilization)
+        else:
+            return "\n  No packing fits on the panel."
+
+    def run(self):
+        totalArea = 0
+        minWidth = 0
+        for Xdim, Ydim, name in self.jobs:
+            totalArea += (Xdim + self.xspacing) * (Ydim + self.yspacing)
+            minWidth = max(minWidth, min(Xdim, Ydim))
+
+        side = totalArea ** 0.5
+        widths = set([self.x])
+        for factor in self.WidthFactors:
+            widths.add(min(self.x, max(minWidth, int(side * factor) - self.xspacing)))
+
+        for order in self.Orders:
+            jobs = sorted(self.jobs, key=order, reverse=True)
+            for width in sorted(widths):
+                for rule in self.Rules:
+                    T = self.pack(jobs, width, rule)
+                    self.placements += 1
+                    if T is not None and T.area() < self.bestScore:
+                        self.bestTiling = T
+                        self.bestScore = T.area()
+
+    def orientations(self, Xdim, Ydim):
+        "Return a list of (W,H,degrees) for the job cell in each orientation"
+        L = [(Xdim + self.xspacing, Ydim + self.yspacing, 0)]
+        if Xdim != Ydim:
+            L.append((Ydim + self.xspacing, Xdim + self.yspacing, 90))
+        return L
+
+
+class SkylineSearch(PackingSearch):
+    """Skyline packing. Each job is placed at the best position along the top
+    edge (the skyline) of the jobs placed so far. It serves as a starting point
+    for the other searches."""
+
+    # The position of a job is chosen as the one where the top of the job is
+    # lowest, then leftmost (bottom-left rule), or as the one which leaves the
+    # least unusable area below the job (minimum-waste rule).
+    BOTTOM_LEFT = 0
+    MIN_WASTE = 1
+    Rules = (BOTTOM_LEFT, MIN_WASTE)
+
+    def pack(self, jobs, width, rule):
+        xmax = width + self.xspacing
+        ymax = self.y + self.yspacing
+        T = tiling.Tiling(self.x, self.y, self.xspacing, self.yspacing)
+
+        # The skyline is a list of 3-tuples (X,Y,W), for the horizontal segments
+        # of width W from (X,Y) to (X+W,Y), from left to right.
+        sky = [(0, 0, xmax)]
+
+        for Xdim, Ydim, name in jobs:
+            best = None
+            for W, H, degrees in self.orientations(Xdim, Ydim):
+                for ix in range(len(sky)):
+                    fit = self.fit(sky, ix, W, H, xmax, ymax)
+                    if fit is None:
+                        continue
+
+                    y, waste = fit
+                    x = sky[ix][0]
+                    if rule == self.BOTTOM_LEFT:
+                        score = (y + H, x)
+                    else:
+                        score = (waste, y + H, x)
+                    if best is None or score < best[0]:
+                        best = (score, ix, x, y, W, H, degrees)
+
+            if best is None:
+                return None
+
+            score, ix, x, y, W, H, degrees = best
+            T.place(x, y, x + W, y + H, name, degrees)
+            sky = self.addToSkyline(sky, ix, x, y + H, W)
+
+        return T
+
+    @staticmethod
+    def fit(sky, ix, W, H, xmax, ymax):
+        """Return (Y,waste) for a job cell of W-by-H placed with its left edge at the
+        start of skyline segment ix, resting at height Y on the skyline and leaving
+        the given area unusable below it. Return None if it exceeds the strip."""
+        x = sky[ix][0]
+        x_tr = x + W
+        if x_tr > xmax:
+            return None
+
+        y = 0
+        for sx, sy, sw in sky[ix:]:
+            if sx >= x_tr:
+                break
+            y = max(y, sy)
+        if y + H > ymax:
+            return None
+
+        waste = 0
+        for sx, sy, sw in sky[ix:]:
+            if sx >= x_tr:
+                break
+            waste += (y - sy) * (min(sx + sw, x_tr) - sx)
+
+        return (y, waste)
+
+    @staticmethod
+    def addToSkyline(sky, ix, x, y, W):
+        "Return the skyline with segment ix onwards covered by a segment of width W at height Y"
+        x_tr = x + W
+        new = sky[:ix] + [(x, y, W)]
+        for sx, sy, sw in sky[ix:]:
+            if sx + sw <= x_tr:
+                continue
+            if sx < x_tr:
+                new.append((x_tr, sy, sx + sw - x_tr))
+            else:
+                new.append((sx, sy, sw))
+
+        # Merge neighbouring segments at the same height
+        merged = [new[0]]
+        for sx, sy, sw in new[1:]:
+            px, py, pw = merged[-1]
+            if py == sy:
+                merged[-1] = (px, py, pw + sw)
+            else:
+                merged.append((sx, sy, sw))
+        return merged
+
+
+class MaxRectsSearch(PackingSearch):
+    """MaxRects packing. The free space of the strip is kept as the list of all
+    maximal free rectangles, which may overlap. Each job is placed in the corner
+    of the free rectangle chosen by the rule, so that unlike the corners of a
+    tiling or a skyline, holes left below overhanging jobs are filled too."""
+
+    # The free rectangle for a job is chosen as the one leaving the shortest
+    # leftover side (best short side fit), the least leftover area (best area
+    # fit) or the one where the job touches the most edges of other jobs and
+    # of the strip (contact point rule).
+    BEST_SHORT_SIDE = 0
+    BEST_AREA = 1
+    CONTACT_POINT = 2
+    Rules = (BEST_SHORT_SIDE, BEST_AREA, CONTACT_POINT)
+
+    def pack(self, jobs, width, rule):
+        xmax = width + self.xspacing
+        ymax = self.y + self.yspacing
+        T = tiling.Tiling(self.x, self.y, self.xspacing, self.yspacing)
+
+        # List of maximal free rectangles (X,Y,Xtr,Ytr), none inside another
+        free = [(0, 0, xmax, ymax)]
+
+        for Xdim, Ydim, name in jobs:
+            best = None
+            for W, H, degrees in self.orientations(Xdim, Ydim):
+                for x, y, x_tr, y_tr in free:
+                    dw = x_tr - x - W
+                    dh = y_tr - y - H
+                    if dw < 0 or dh < 0:
+                        continue
+
+                    if rule == self.BEST_SHORT_SIDE:
+                        score = (min(dw, dh), max(dw, dh), y, x)
+                    elif rule == self.BEST_AREA:
+                        score = ((x_tr - x) * (y_tr - y) - W * H, min(dw, dh), y, x)
+                    else:
+                        score = (-self.contact(T.jobs, x, y, x + W, y + H, xmax, ymax), y, x)
+                    if best is None or score < best[0]:
+                        best = (score, x, y, W, H, degrees)
+
+            if best is None:
+                return None
+
+            score, x, y, W, H, degrees = best
+            T.place(x, y, x + W, y + H, name, degrees)
+            free = self.splitFree(free, (x, y, x + W, y + H))
+
+        return T
+
+    @staticmethod
+    def contact(placed, x, y, x_tr, y_tr, xmax, ymax):
+        "Return the length of the edges of the cell (x,y)-(x_tr,y_tr) touching the strip edges or placed jobs"
+        length = 0
+        if x == 0 or x_tr == xmax:
+            length += y_tr - y
+        if y == 0 or y_tr == ymax:
+            length += x_tr - x
+
+        for t_x, t_y, t_x_tr, t_y_tr, name, degrees in placed:
+            if t_x_tr == x or t_x == x_tr:
+                length += max(0, min(y_tr, t_y_tr) - max(y, t_y))
+            if t_y_tr == y or t_y == y_tr:
+                length += max(0, min(x_tr, t_x_tr) - max(x, t_x))
+        return length
+
+    @staticmethod
+    def splitFree(free, cell):
+        """Return the list of maximal free rectangles left when the cell is taken out
+        of them. Free rectangles overlapping the cell are split into up to four
+        maximal pieces around it. Only the new pieces need pruning, since any
+        rectangle inside one of them would already be inside the rectangle that
+        was split."""
+        x, y, x_tr, y_tr = cell
+        kept = []
+        pieces = []
+        for F in free:
+            f_x, f_y, f_x_tr, f_y_tr = F
+            if x >= f_x_tr or x_tr <= f_x or y >= f_y_tr or y_tr <= f_y:
+                kept.append(F)
+                continue
+
+            if x > f_x:
+                pieces.append((f_x, f_y, x, f_y_tr))
+            if x_tr < f_x_tr:
+                pieces.append((x_tr, f_y, f_x_tr, f_y_tr))
+            if y > f_y:
+                pieces.append((f_x, f_y, f_x_tr, y))
+            if y_tr < f_y_tr:
+                pieces.append((f_x, y_tr, f_x_tr, f_y_tr))
+
+        def inside(A, B):
+            return A[0] >= B[0] and A[1] >= B[1] and A[2] <= B[2] and A[3] <= B[3]
+
+        new = []
+        for ix, P in enumerate(pieces):
+            if any(inside(P, F) for F in kept):
+                continue
+            # Of identical pieces, keep the first
+            if any(inside(P, Q) and (P != Q or jx < ix) for jx, Q in enumerate(pieces) if jx != ix):
+                continue
+            new.append(P)
+
+        return kept + new
+
+
+class GuillotineSearch(PackingSearch):
+    """Guillotine packing. Only tilings which can be taken apart into single jobs
+    by cuts going all the way across each piece are produced, as needed for
+    V-scoring. The tree of cuts is kept in the cuts of the tiling.
+
+    If the jobs are few enough, or mostly copies of each other, all such tilings
+    are searched. The shapes of each multiset of jobs are those of the two parts
+    of each way of splitting it in two, placed side by side or on top of each
+    other. They are memoized for each multiset, and only shapes which are not
+    larger in both dimensions than another are kept. Otherwise the jobs are
+    packed one by one into free rectangles, splitting each rectangle a job is
+    placed into by two cuts."""
+
+    # Largest number of ways of splitting all the multisets of the jobs in two
+    # for which all tilings are searched
+    ExactLimit = 7000
+
+    # The free rectangle for a job is chosen as the one where the top of the
+    # job is lowest, the one leaving the shortest leftover side or the one
+    # leaving the least leftover area. The rest of the rectangle is then split
+    # either across its shorter leftover side, or such that the larger of the
+    # two free rectangles is as large as possible.
+    BOTTOM_LEFT = 0
+    BEST_SHORT_SIDE = 1
+    BEST_AREA = 2
+    SPLIT_SHORTER_SIDE = 0
+    SPLIT_MAX_AREA = 1
+    Rules = ((BOTTOM_LEFT, SPLIT_SHORTER_SIDE), (BOTTOM_LEFT, SPLIT_MAX_AREA),
+             (BEST_SHORT_SIDE, SPLIT_SHORTER_SIDE), (BEST_SHORT_SIDE, SPLIT_MAX_AREA),
+             (BEST_AREA, SPLIT_SHORTER_SIDE), (BEST_AREA, SPLIT_MAX_AREA))
+
+    def run(self):
+        groups = sorted(set(self.jobs))
+        counts = tuple(self.jobs.count(job) for job in groups)
+
+        splits = 1
+        for count in counts:
+            splits *= (count + 1) * (count + 2) // 2
+
+        if splits <= self.ExactLimit:
+            self.searchAll(groups, counts)
+        else:
+            PackingSearch.run(self)
+
+    def searchAll(self, groups, counts):
+        "Find the guillotine tiling of smallest area by searching all of them"
+        xmax = self.x + self.xspacing
+        ymax = self.y + self.yspacing
+
+        # Map each multiset, as a tuple of counts of each group, to the list of
+        # its shapes (W,H,spec). The spec is either (name,degrees) for a single
+        # job, or (vertical,A,B) for shapes A and B left of/below each other.
+        memo = {}
+        for ix, (Xdim, Ydim, name) in enumerate(groups):
+            single = tuple(int(i == ix) for i in range(len(groups)))
+            memo[single] = self.pareto([(W, H, (name, degrees))
+                                        for W, H, degrees in self.orientations(Xdim, Ydim)
+                                        if W <= xmax and H <= ymax])
+
+        def shapes(key):
+            try:
+                return memo[key]
+            except KeyError:
+                pass
+
+            L = []
+            for part in self.parts(key):
+                rest = tuple(n - p for n, p in zip(key, part))
+                if part > rest:
+                    continue    # The same split was already done the other way round
+                for A in shapes(part):
+                    for B in shapes(rest):
+                        W, H = A[0] + B[0], max(A[1], B[1])
+                        if W <= xmax and H <= ymax:
+                            L.append((W, H, (True, A, B)))
+                        W, H = max(A[0], B[0]), A[1] + B[1]
+                        if W <= xmax and H <= ymax:
+                            L.append((W, H, (False, A, B)))
+                        self.placements += 2
+
+            memo[key] = L = self.pareto(L)
+            return L
+
+        L = shapes(counts)
+        if L:
+            best = min(L, key=lambda shape: (shape[0] - self.xspacing) * (shape[1] - self.yspacing))
+            T = tiling.Tiling(self.x, self.y, self.xspacing, self.yspacing)
+            T.cuts = self.layout(T, best, 0, 0)
+            self.bestTiling = T
+            self.bestScore = T.area()
+
+    @staticmethod
+    def parts(key):
+        "Generate all multisets that are neither empty nor all of the multiset key"
+        part = [0] * len(key)
+        while True:
+            # Count up like an odometer with the counts of key as digits
+            for ix in range(len(key)):
+                if part[ix] < key[ix]:
+                    part[ix] += 1
+                    break
+                part[ix] = 0
+            else:
+                return
+
+            T = tuple(part)
+            if T != key:
+                yield T
+
+    @staticmethod
+    def pareto(L):
+        "Return the shapes of L which are not at least as large in both dimensions as another"
+        L.sort(key=lambda shape: (shape[0], shape[1]))
+        front = []
+        for shape in L:
+            if not front or shape[1] < front[-1][1]:
+                front.append(shape)
+        return front
+
+    def layout(self, T, shape, x, y):
+        "Place the jobs of the shape on the tiling at (x,y) and return its cut tree"
+        W, H, spec = shape
+        if len(spec) == 2:
+            name, degrees = spec
+            T.place(x, y, x + W, y + H, name, degrees)
+            return None
+
+        vertical, A, B = spec
+        if vertical:
+            # The lower of the two parts is cut off the waste above it
+            lo = self.layout(T, A, x, y)
+            if A[1] < H:
+                lo = (False, y + A[1], lo, None)
+            hi = self.layout(T, B, x + A[0], y)
+            if B[1] < H:
+                hi = (False, y + B[1], hi, None)
+            return (True, x + A[0], lo, hi)
+        else:
+            lo = self.layout(T, A, x, y)
+            if A[0] < W:
+                lo = (True, x + A[0], lo, None)
+            hi = self.layout(T, B, x, y + A[1])
+            if B[0] < W:
+                hi = (True, x + B[0], hi, None)
+            return (False, y + A[1], lo, hi)
+
+    def pack(self, jobs, width, rule):
+        choice, split = rule
+        xmax = width + self.xspacing
+        ymax = self.y + self.yspacing
+        T = tiling.Tiling(self.x, self.y, self.xspacing, self.yspacing)
+
+        # List of disjoint free rectangles (X,Y,Xtr,Ytr,node,ix), where node[ix]
+        # is the place in the cut tree for the cuts made in the rectangle.
+        root = [None]
+        free = [(0, 0, xmax, ymax, root, 0)]
+
+        for Xdim, Ydim, name in jobs:
+            best = None
+            for W, H, degrees in self.orientations(Xdim, Ydim):
+                for ix, (x, y, x_tr, y_tr, node, slot) in enumerate(free):
+                    dw = x_tr - x - W
+                    dh = y_tr - y - H
+                    if dw < 0 or dh < 0:
+                        continue
+
+                    if choice == self.BOTTOM_LEFT:
+                        score = (y + H, x, min(dw, dh))
+                    elif choice == self.BEST_SHORT_SIDE:
+                        score = (min(dw, dh), max(dw, dh), y, x)
+                    else:
+                        score = ((x_tr - x) * (y_tr - y) - W * H, min(dw, dh), y, x)
+                    if best is None or score < best[0]:
+                        best = (score, ix, W, H, degrees)
+
+            if best is None:
+                return None
+
+            score, ix, W, H, degrees = best
+            x, y, x_tr, y_tr, node, slot = free.pop(ix)
+            T.place(x, y, x + W, y + H, name, degrees)
+
+            dw = x_tr - x - W
+            dh = y_tr - y - H
+            if split == self.SPLIT_SHORTER_SIDE:
+                horizontal = dw <= dh
+            else:
+                horizontal = max((x_tr - x) * dh, dw * H) >= max(dw * (y_tr - y), W * dh)
+
+            # The nodes are lists, for the cuts in the free rectangles left to be filled in
+            if horizontal:
+                # Cut across at the top of the job, then beside the job below that
+                inner = [True, x + W, None, None]
+                outer = [False, y + H, inner, None]
+                if dw:
+                    free.append((x + W, y, x_tr, y + H, inner, 3))
+                if dh:
+                    free.append((x, y + H, x_tr, y_tr, outer, 3))
+            else:
+                # Cut beside the job, then across at the top of the job left of that
+                inner = [False, y + H, None, None]
+                outer = [True, x + W, inner, None]
+                if dh:
+                    free.append((x, y + H, x + W, y_tr, inner, 3))
+                if dw:
+                    free.append((x + W, y, x_tr, y_tr, outer, 3))
+            node[slot] = outer
+
+        T.cuts = root[0]
+        return T
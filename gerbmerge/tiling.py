@@ -9,6 +9,10 @@ of two things:
   - a list of points that begins at (0,Ymax) and ends at
     (Xmax,0). These points describe the outside boundary
     of the tiling.
+
+All dimensions are integers in units of the tiling grid, so
+that corners compare exactly. Conversion to inches is done
+by canonicalize().
 --------------------------------------------------------------------
 
 This program is licensed under the GNU General Public License (GPL)
@@ -22,6 +26,20 @@ import sys
 import math
 
 import jobs
+import config
+
+# Number of placed jobs from which on Tiling.isOverlap() looks up nearby jobs
+# in a grid index rather than testing against all jobs.
+GridThreshold = 16
+
+# Size of one unit of the tiling grid in inches. This is the resolution of the
+# Gerber data (2.5 format), so job dimensions are exact.
+Unit = 0.00001
+
+
+def toUnits(inches):
+    "Convert a dimension in inches to an integer number of tiling grid units"
+    return int(round(inches / Unit))
 
 
 # Helper functions to determine if points are right-of, left-of, above, and
@@ -44,6 +62,10 @@ def below(p1, p2):
 
 
 class Tiling:
+    # Search creates a great many clones of tilings, so keep them small
+    __slots__ = ('xspacing', 'yspacing', 'xmax', 'ymax', 'points', 'jobs', 'minX', 'minY', 'maxX', 'maxY', 'used', 'log', 'frames',
+                 'grid', 'cellw', 'cellh', 'cornerCache', 'addPointCache', 'cuts')
+
     def __init__(self, Xmax, Ymax, xspacing, yspacing):
         # Store the interjob spacing
         self.xspacing = xspacing
@@ -57,28 +79,123 @@ class Tiling:
         self.ymax = Ymax + self.yspacing
 
         self.points = [(0, Ymax), (0, 0), (Xmax, 0)]    # List of (X,Y) co-ordinates
-        self.jobs = []   # List of 3-tuples: ((Xbl,Ybl),(Xtr,Ytr),Job) where
+        self.jobs = []   # List of 6-tuples: (Xbl,Ybl,Xtr,Ytr,name,degrees) where
                          # (Xbl,Ybl) is bottom left, (Xtr,Ytr) is top-right of the cell.
                          # The actual job has dimensions (Xtr-Xbl-xspacing],Ytr-Ybl-yspacing)
-                         # and is located at the lower-left of the cell.
+                         # and is located at the lower-left of the cell. The job is the one
+                         # named in config.Jobs, rotated by the given degrees (0 or 90).
+
+        # Bounds of all job cells and total area of the jobs themselves, kept
+        # up to date as jobs are added so that bounds(), area() and usedArea()
+        # need not look at every job.
+        self.minX = self.minY = float("inf")
+        self.maxX = self.maxY = 0
+        self.used = 0
+
+        # Undo log for push() and pop(). Each edit of the points while a job is
+        # pushed is logged as a 3-tuple (ix, N, old) meaning that the N points
+        # at self.points[ix] replaced the list of points old. Each pushed job
+        # has a frame holding the length of the log and of self.jobs, and the
+        # bounds and used area, from before it was added.
+        self.log = []
+        self.frames = []
+
+        # Once there are GridThreshold jobs, the jobs are also kept in a grid of
+        # cellw-by-cellh cells about the size of a job. The dictionary maps cell
+        # co-ordinates (x//cellw,y//cellh) to the list of jobs overlapping the cell.
+        self.grid = None
+        self.cellw = self.cellh = 0
+
+        # The list of (ix, isL) for all L-points and mirrored-L-points, and a
+        # dictionary mapping job dimensions (X,Y) to the result of
+        # validAddPoints(X,Y), for the current state of the tiling. Either is
+        # None when not yet computed. Both are reset when points or jobs change,
+        # and saved by push() to be restored by pop().
+        self.cornerCache = None
+        self.addPointCache = None
+
+        # For tilings built by a guillotine packer, the tree of end-to-end cuts
+        # separating the jobs, else None. A node is a sequence (vertical,pos,lo,hi)
+        # for a cut at X=pos (vertical) or Y=pos through the rectangle of the node,
+        # where lo and hi are the nodes of the parts left of/below and right
+        # of/above the cut. A part that is None is a single job cell or waste.
+        self.cuts = None
 
     def canonicalize(self, OriginX, OriginY):
-        """Return a list of JobLayout objects, after setting each job's (X,Y) origin"""
+        """Return a list of JobLayout objects, after setting each job's (X,Y) origin.
+        Rotated jobs are only constructed here, for the jobs that need them."""
         L = []
-        for job in self.jobs:
-            J = jobs.JobLayout(job[2])
-            J.setPosition(job[0][0] + OriginX, job[0][1] + OriginY)
+        for x, y, x_tr, y_tr, name, degrees in self.jobs:
+            J = jobs.JobLayout(jobs.findRotatedJob(config.Jobs[name], degrees))
+            J.setPosition(x * Unit + OriginX, y * Unit + OriginY)
             L.append(J)
 
         return L
 
+    def scoreLines(self, OriginX, OriginY):
+        """Return the cuts of the cut tree as a list of lines (x1,y1,x2,y2) in inches,
+        placed like the jobs by canonicalize(), along with the four cuts around
+        the tiling. Each line is in the middle of the spacing between the cells on
+        either side of it. Ends of lines at the edge of the tiling are made
+        infinite, to be trimmed to the panel extents."""
+        dx = self.xspacing * Unit / 2
+        dy = self.yspacing * Unit / 2
+
+        def toX(x):
+            return x * Unit + OriginX - dx
+
+        def toY(y):
+            return y * Unit + OriginY - dy
+
+        minX, minY, maxX, maxY = self.minX, self.minY, self.maxX, self.maxY
+        inf = float("inf")
+
+        # The cuts around the tiling separate it from the margins of the panel
+        L = [(-inf, toY(minY), inf, toY(minY)), (-inf, toY(maxY), inf, toY(maxY)),
+             (toX(minX), -inf, toX(minX), inf), (toX(maxX), -inf, toX(maxX), inf)]
+
+        def walk(node, x, y, x_tr, y_tr):
+            while node is not None:
+                vertical, pos, lo, hi = node
+
+                # Cuts outside of the rectangle only separate waste
+                if pos <= (x if vertical else y):
+                    node = hi
+                    continue
+                if pos >= (x_tr if vertical else y_tr):
+                    node = lo
+                    continue
+
+                if vertical:
+                    L.append((toX(pos), toY(y) if y > minY else -inf, toX(pos), toY(y_tr) if y_tr < maxY else inf))
+                    walk(lo, x, y, pos, y_tr)
+                    x = pos
+                else:
+                    L.append((toX(x) if x > minX else -inf, toY(pos), toX(x_tr) if x_tr < maxX else inf, toY(pos)))
+                    walk(lo, x, y, x_tr, pos)
+                    y = pos
+                node = hi
+
+        walk(self.cuts, minX, minY, maxX, maxY)
+        return L
+
     def corners(self):
         return len(self.points) - 2
 
     def clone(self):
-        T = Tiling(self.xmax - self.xspacing, self.ymax - self.yspacing, self.xspacing, self.yspacing)
+        # Lists are copied, but the tuples in them are shared
+        T = Tiling.__new__(Tiling)
+        T.xspacing, T.yspacing, T.xmax, T.ymax = self.xspacing, self.yspacing, self.xmax, self.ymax
         T.points = self.points[:]
         T.jobs = self.jobs[:]
+        T.log = []
+        T.frames = []
+        T.grid = dict((cell, L[:]) for cell, L in self.grid.items()) if self.grid is not None else None
+        T.cellw, T.cellh = self.cellw, self.cellh
+        T.cornerCache = T.addPointCache = None
+        T.minX, T.minY, T.maxX, T.maxY = self.minX, self.minY, self.maxX, self.maxY
+        T.used = self.used
+        T.cuts = self.cuts
         return T
 
     def dump(self, fid=sys.stdout):
@@ -94,15 +211,15 @@ class Tiling:
             fid.write("\n")
 
         fid.write("Jobs:\n")
-        for bl, tr, Job in self.jobs:
-            fid.write("  {:s}: {:s}\n".format(Job, bl))
+        for x, y, x_tr, y_tr, name, degrees in self.jobs:
+            fid.write("  {:s}: {}\n".format(name if not degrees else "{:s}*rotated{:d}".format(name, degrees), (x, y)))
 
     def joblist(self, fid=sys.stdout):
-        for bl, tr, Job in self.jobs:
-            fid.write("{}@({:.1f},{:.1f}) ".format(Job.name, bl[0], bl[1]))
+        for x, y, x_tr, y_tr, name, degrees in self.jobs:
+            fid.write("{}@({:.1f},{:.1f}) ".format(name, x * Unit, y * Unit))
         fid.write('\n')
 
-    def isOverlap(self, ix, X, Y):
+    def isOverlap(self, ix, X, Y, isL=None):
         """Determines if a new job with actual dimensions X-by-Y located at self.points[ix]
            overlaps any existing job or exceeds the boundaries of the panel.
 
@@ -127,8 +244,13 @@ class Tiling:
               p.left_edge<t.right_edge and p.right_edge>t.left_edge
                                        and
               p.bottom_edge<t.top_edge and p.top_edge>t.bottom_edge
+
+           If known, whether the point is an L-point can be passed as isL.
         """
-        if self.isL(ix):
+        if isL is None:
+            isL = self.isL(ix)
+
+        if isL:
             p_bl = self.points[ix]
             p_tr = (p_bl[0] + X, p_bl[1] + Y)
             if p_tr[0] > self.xmax or p_tr[1] > self.ymax:
@@ -139,12 +261,34 @@ class Tiling:
             if p_bl[0] < 0 or p_tr[1] > self.ymax:
                 return 1
 
-        for t_bl, t_tr, Job in self.jobs:
-            if (p_bl[0] < t_tr[0] and p_tr[0] > t_bl[0]) and (p_bl[1] < t_tr[1] and p_tr[1] > t_bl[1]):
-                return 1
+        if self.grid is None:
+            for t_x, t_y, t_x_tr, t_y_tr, name, degrees in self.jobs:
+                if (p_bl[0] < t_x_tr and p_tr[0] > t_x) and (p_bl[1] < t_y_tr and p_tr[1] > t_y):
+                    return 1
+        else:
+            grid = self.grid
+            for cx in range(p_bl[0] // self.cellw, (p_tr[0] - 1) // self.cellw + 1):
+                for cy in range(p_bl[1] // self.cellh, (p_tr[1] - 1) // self.cellh + 1):
+                    for t_x, t_y, t_x_tr, t_y_tr, name, degrees in grid.get((cx, cy), ()):
+                        if (p_bl[0] < t_x_tr and p_tr[0] > t_x) and (p_bl[1] < t_y_tr and p_tr[1] > t_y):
+                            return 1
 
         return 0
 
+    def cells(self, job):
+        "Return the co-ordinates of the grid cells overlapped by a job"
+        x, y, x_tr, y_tr = job[:4]
+        return [(cx, cy) for cx in range(x // self.cellw, (x_tr - 1) // self.cellw + 1) for cy in range(y // self.cellh, (y_tr - 1) // self.cellh + 1)]
+
+    def buildGrid(self):
+        "Construct the grid index of the jobs, with cells of the average job size"
+        self.cellw = max(1, sum(job[2] - job[0] for job in self.jobs) // len(self.jobs))
+        self.cellh = max(1, sum(job[3] - job[1] for job in self.jobs) // len(self.jobs))
+        self.grid = {}
+        for job in self.jobs:
+            for cell in self.cells(job):
+                self.grid.setdefault(cell, []).append(job)
+
     def isL(self, ix):
         """True if self.points[ix] represents an L-shaped corner where there
            is free space above and to the right, like this:
@@ -192,9 +336,27 @@ class Tiling:
         """Return a list of all valid indices into self.points at which we can add
         the job with dimensions X-by-Y). Only points which are either L-points or
         mirrored-L-points and which would support the given job with no overlaps
-        are returned.
+        are returned. The result is cached until the tiling changes, so the list
+        must not be modified.
         """
-        return [ix for ix in range(1, len(self.points) - 1) if (self.isL(ix) or self.isMirrorL(ix)) and not self.isOverlap(ix, X, Y)]
+        if self.addPointCache is None:
+            self.addPointCache = {}
+        else:
+            try:
+                return self.addPointCache[X, Y]
+            except KeyError:
+                pass
+
+        if self.cornerCache is None:
+            self.cornerCache = []
+            for ix in range(1, len(self.points) - 1):
+                if self.isL(ix):
+                    self.cornerCache.append((ix, True))
+                elif self.isMirrorL(ix):
+                    self.cornerCache.append((ix, False))
+
+        addpoints = self.addPointCache[X, Y] = [ix for ix, isL in self.cornerCache if not self.isOverlap(ix, X, Y, isL)]
+        return addpoints
 
     def mergePoints(self, ix):
         """Inspect points self.points[ix] and self.points[ix+1] as well
@@ -204,10 +366,17 @@ class Tiling:
 
         # Do farther-on points first so we can delete things right from the list
         if self.points[ix + 3] == self.points[ix + 4]:
-            del self.points[ix + 3:ix + 5]
+            self.splice(ix + 3, ix + 5, [])
 
         if self.points[ix] == self.points[ix + 1]:
-            del self.points[ix:ix + 2]
+            self.splice(ix, ix + 2, [])
+
+    def splice(self, i, j, new):
+        "Replace self.points[i:j] by the list of points new, logging the edit if any job is pushed"
+        if self.frames:
+            self.log.append((i, len(new), self.points[i:j]))
+        self.points[i:j] = new
+        self.cornerCache = self.addPointCache = None
 
     # Experimental
     def removeInlets(self, minSize):
@@ -238,47 +407,49 @@ class Tiling:
            that are too small for any job to fit in (as defined by minSize). These inlets
            can be deleted to form corners where new jobs can be placed.
         """
+        # After an edit at pt[ix:ix+4], only the inlets that include one of those
+        # points can have changed, the earliest of which starts at pt[ix-3]. The
+        # scan resumes there, rather than from the start, so that inlets are
+        # still removed in the same order while the whole pass takes linear time.
         pt = self.points
-        done = 0
-
-        while not done:
-            # Repeat this loop each time there is a change
-            for ix in range(0, len(pt) - 3):
-
-                # Check for horizontal left-going inlet
-                if right_of(pt[ix], pt[ix + 1]) and above(pt[ix + 1], pt[ix + 2]) and left_of(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix][1] - pt[ix + 3][1] < minSize:
-                        # Get rid of middle two points, extend Y-value of highest point down to lowest point
-                        pt[ix] = (pt[ix][0], pt[ix + 3][1])
-                        del pt[ix + 1:ix + 3]
-                        break
-
-                # Check for horizontal right-going inlet
-                if left_of(pt[ix], pt[ix + 1]) and below(pt[ix + 1], pt[ix + 2]) and right_of(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix + 3][1] - pt[ix][1] < minSize:
-                        # Get rid of middle two points, exten Y-value of highest point down to lowest point
-                        pt[ix + 3] = (pt[ix + 3][0], pt[ix][1])
-                        del pt[ix + 1:ix + 3]
-                        break
-
-                # Check for vertical inlets
-                if above(pt[ix], pt[ix + 1]) and left_of(pt[ix + 1], pt[ix + 2]) and below(pt[ix + 2], pt[ix + 3]):
-                    # Make sure minSize requirement is met
-                    if pt[ix + 3][0] - pt[ix][0] < minSize:
-                        # Is right side lower or higher?
-                        if pt[ix + 3][1] >= pt[ix][1]:   # higher?
-                            pt[ix] = (pt[ix + 3][0], pt[ix][1])  # Move first point to the right
-                        else:                        # lower?
-                            pt[ix + 3] = (pt[ix][0], pt[ix + 3][1])  # Move last point to the left
-                        del pt[ix + 1:ix + 3]
-                        break
-
-            else:
-                done = 1
-
-    def addLJob(self, ix, X, Y, Job):
+        ix = 0
+
+        while ix < len(pt) - 3:
+            p0, p1, p2, p3 = pt[ix:ix + 4]
+
+            # Check for horizontal left-going inlet
+            if right_of(p0, p1) and above(p1, p2) and left_of(p2, p3):
+                # Make sure minSize requirement is met
+                if p0[1] - p3[1] < minSize:
+                    # Get rid of middle two points, extend Y-value of highest point down to lowest point
+                    self.splice(ix, ix + 3, [(p0[0], p3[1])])
+                    ix = max(ix - 3, 0)
+                    continue
+
+            # Check for horizontal right-going inlet
+            if left_of(p0, p1) and below(p1, p2) and right_of(p2, p3):
+                # Make sure minSize requirement is met
+                if p3[1] - p0[1] < minSize:
+                    # Get rid of middle two points, exten Y-value of highest point down to lowest point
+                    self.splice(ix + 1, ix + 4, [(p3[0], p0[1])])
+                    ix = max(ix - 3, 0)
+                    continue
+
+            # Check for vertical inlets
+            if above(p0, p1) and left_of(p1, p2) and below(p2, p3):
+                # Make sure minSize requirement is met
+                if p3[0] - p0[0] < minSize:
+                    # Is right side lower or higher?
+                    if p3[1] >= p0[1]:   # higher?
+                        self.splice(ix, ix + 3, [(p3[0], p0[1])])  # Move first point to the right
+                    else:                # lower?
+                        self.splice(ix + 1, ix + 4, [(p0[0], p3[1])])  # Move last point to the left
+                    ix = max(ix - 3, 0)
+                    continue
+
+            ix += 1
+
+    def addLJob(self, ix, X, Y, name, degrees=0):
         """Add a job to the tiling at L-point self.points[ix] with actual dimensions X-by-Y.
         The job is added with its lower-left corner at the point. The existing point
         is removed from the tiling and new points are added at the top-left, top-right
@@ -287,12 +458,12 @@ class Tiling:
         x, y = self.points[ix]
         x_tr = x + X
         y_tr = y + Y
-        self.points[ix:ix + 1] = [(x, y_tr), (x_tr, y_tr), (x_tr, y)]
-        self.jobs.append(((x, y), (x_tr, y_tr), Job))
+        self.splice(ix, ix + 1, [(x, y_tr), (x_tr, y_tr), (x_tr, y)])
+        self.place(x, y, x_tr, y_tr, name, degrees)
 
         self.mergePoints(ix - 1)
 
-    def addMirrorLJob(self, ix, X, Y, Job):
+    def addMirrorLJob(self, ix, X, Y, name, degrees=0):
         """Add a job to the tiling at mirror-L-point self.points[ix] with dimensions X-by-Y.
         The job is added with its lower-right corner at the point. The existing point
         is removed from the tiling and new points are added at the bottom-left, top-left
@@ -301,60 +472,88 @@ class Tiling:
         x_tr, y = self.points[ix]
         x = x_tr - X
         y_tr = y + Y
-        self.points[ix:ix + 1] = [(x, y), (x, y_tr), (x_tr, y_tr)]
-        self.jobs.append(((x, y), (x_tr, y_tr), Job))
+        self.splice(ix, ix + 1, [(x, y), (x, y_tr), (x_tr, y_tr)])
+        self.place(x, y, x_tr, y_tr, name, degrees)
 
         self.mergePoints(ix - 1)
 
-    def addJob(self, ix, X, Y, Job):
+    def place(self, x, y, x_tr, y_tr, name, degrees):
+        """Record a job placed in the cell (x,y)-(x_tr,y_tr) and update bounds and used area.
+        The points are not updated, so tilings built this way (e.g., by the packers
+        in tilesearch) cannot have jobs added by addJob() or be compared on corners()."""
+        job = (x, y, x_tr, y_tr, name, degrees)
+        self.jobs.append(job)
+        self.addPointCache = None
+        if self.grid is not None:
+            for cell in self.cells(job):
+                self.grid.setdefault(cell, []).append(job)
+        elif len(self.jobs) >= GridThreshold:
+            self.buildGrid()
+
+        self.minX = min(self.minX, x)
+        self.minY = min(self.minY, y)
+        self.maxX = max(self.maxX, x_tr)
+        self.maxY = max(self.maxY, y_tr)
+        self.used += (x_tr - x - self.xspacing) * (y_tr - y - self.yspacing)
+
+    def addJob(self, ix, X, Y, name, degrees=0):
         """Add a job to the tiling at point self.points[ix] and with dimensions X-by-Y.
         If the given point is an L-point, the job will be added with its lower-left
         corner at the point. If the given point is a mirrored-L point, the job will
-        be added with its lower-right corner at the point.
+        be added with its lower-right corner at the point. The job is identified by
+        its name and the degrees it is rotated by.
         """
         if self.isL(ix):
-            self.addLJob(ix, X, Y, Job)
+            self.addLJob(ix, X, Y, name, degrees)
         else:
-            self.addMirrorLJob(ix, X, Y, Job)
+            self.addMirrorLJob(ix, X, Y, name, degrees)
+
+    def push(self, ix, X, Y, name, degrees=0):
+        """Add a job like addJob(), in such a way that pop() can take it off again.
+        Any points changed by removeInlets() until then are restored by pop() too.
+        This lets a search try out jobs on a single tiling rather than on clones.
+        """
+        self.frames.append((len(self.log), len(self.jobs), self.minX, self.minY, self.maxX, self.maxY, self.used, self.cornerCache, self.addPointCache))
+        self.addJob(ix, X, Y, name, degrees)
+
+    def pop(self):
+        "Undo the last push(), and any changes made to the points since"
+        mark, njobs, self.minX, self.minY, self.maxX, self.maxY, self.used, self.cornerCache, self.addPointCache = self.frames.pop()
+
+        log = self.log
+        points = self.points
+        while len(log) > mark:
+            i, n, old = log.pop()
+            points[i:i + n] = old
+
+        if self.grid is not None:
+            # The jobs taken off are the last ones added to each of their cells
+            for job in self.jobs[njobs:]:
+                for cell in self.cells(job):
+                    self.grid[cell].pop()
+        del self.jobs[njobs:]
 
     def bounds(self):
         """Return 2-tuple ((minX, minY), (maxX, maxY)) of rectangular region defined by all jobs"""
-        minX = minY = float("inf")
-        maxX = maxY = 0.0
-
-        for bl, tr, job in self.jobs:
-            minX = min(minX, bl[0])
-            maxX = max(maxX, tr[0])
-            minY = min(minY, bl[1])
-            maxY = max(maxY, tr[1])
-
-        return ((minX, minY), (maxX - self.xspacing, maxY - self.yspacing))
+        return ((self.minX, self.minY), (self.maxX - self.xspacing, self.maxY - self.yspacing))
 
     def area(self):
-        """Return area of rectangular region defined by all jobs."""
-        bl, tr = self.bounds()
-
-        DX = tr[0] - bl[0]
-        DY = tr[1] - bl[1]
-        return DX * DY
+        """Return area of rectangular region defined by all jobs, in square units."""
+        return (self.maxX - self.xspacing - self.minX) * (self.maxY - self.yspacing - self.minY)
 
     def usedArea(self):
-        """Return total area of just jobs, not spaces in-between."""
-        area = 0.0
-        for job in self.jobs:
-            area += job[2].jobarea()
-
-        return area
+        """Return total area of just jobs, not spaces in-between, in square units."""
+        return self.used
 
 
 # Function to estimate the maximum possible utilization given a list of jobs.
-# Jobs list is 4-tuple (Xdim, Ydim, job, rjob).
+# Jobs list is 3-tuple (Xdim, Ydim, name).
 def maxUtilization(Jobs, xspacing, yspacing):
-    usedArea = totalArea = 0.0
-    for Xdim, Ydim, job, rjob in Jobs:
-        usedArea += job.jobarea()
-        totalArea += job.jobarea()
-        totalArea += job.width_in() * xspacing + job.height_in() * yspacing + xspacing * yspacing
+    usedArea = totalArea = 0
+    for Xdim, Ydim, name in Jobs:
+        usedArea += Xdim * Ydim
+        totalArea += Xdim * Ydim
+        totalArea += Xdim * xspacing + Ydim * yspacing + xspacing * yspacing
 
     # Reduce total area by strip of unused spacing around top and side. Assume
     # final result will be approximately square.
@@ -368,7 +567,7 @@ def maxUtilization(Jobs, xspacing, yspacing):
 # Used to remove inlets.
 def minDimension(Jobs):
     M = float("inf")
-    for Xdim, Ydim, job, rjob in Jobs:
+    for Xdim, Ydim, name in Jobs:
         M = min(M, Xdim)
         M = min(M, Ydim)
     return M
@@ -28,3 +28,125 @@ def mil2gerb(value):
 
 def in2mil(value):
     return float(value) * 1000.0
+
+
+class CodeTable(dict):
+    """A dictionary keyed by codes such as 'D12' or 'M3' that keeps track of
+    the next unused code. This is used for the global aperture table (GAT),
+    the global aperture macro table (GAMT) and the per-layer aperture
+    translation tables so that allocating a new code does not require parsing
+    and sorting every key in the table.
+
+    The table also keeps a reverse index from value to code, so values must
+    be hashable."""
+
+    def __init__(self, prefix, first=1):
+        dict.__init__(self)
+        self.prefix = prefix
+        self.first = first
+        self.nextCode = first
+        self.codes = {}     # Maps value to the first code it was stored under
+        self.holders = {}   # Maps value to a dictionary of all codes it is stored under, in order
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self._unindex(key)
+        dict.__setitem__(self, key, value)
+        self.codes.setdefault(value, key)
+        self.holders.setdefault(value, {})[key] = None
+        try:
+            num = int(key[len(self.prefix):])
+        except ValueError:
+            return
+        if num >= self.nextCode:
+            self.nextCode = num + 1
+
+    def __delitem__(self, key):
+        self._unindex(key)
+        dict.__delitem__(self, key)
+
+    def _unindex(self, key):
+        value = self[key]
+        holders = self.holders[value]
+        del holders[key]
+        if not holders:
+            del self.holders[value]
+        if self.codes.get(value) == key:
+            del self.codes[value]
+            # Another code may hold the same value
+            if holders:
+                self.codes[value] = next(iter(holders))
+
+    def __reduce__(self):
+        # Tables travel with Job objects to search processes, so make sure the
+        # prefix is restored before any entries are added back.
+        return (self.__class__, (self.prefix, self.first), None, None, iter(self.items()))
+
+    def clear(self):
+        dict.clear(self)
+        self.codes.clear()
+        self.holders.clear()
+        self.nextCode = self.first
+
+    def alias(self, value, code):
+        """Make codeOf(value) return 'code' even though value is not stored
+        in the table itself"""
+        self.codes[value] = code
+
+    def codeOf(self, value):
+        """Return the code under which value is stored, or None"""
+        return self.codes.get(value)
+
+    def newCode(self):
+        """Return the next unused code (e.g., 'D57'). The code is not reserved
+        until something is stored under it."""
+        return "{:s}{:d}".format(self.prefix, self.nextCode)
+
+    def add(self, value):
+        """Store value under the next unused code and return that code"""
+        code = self.newCode()
+        self[code] = value
+        return code
+
+
+if __name__ == "__main__":
+    class Value:
+        "A hashable value counting how often it is compared"
+        compares = 0
+
+        def __init__(self, n):
+            self.n = n
+
+        def __hash__(self):
+            return hash(self.n)
+
+        def __eq__(self, other):
+            Value.compares += 1
+            return self.n == other.n
+
+    T = CodeTable('D', 11)
+    T['D11'] = T['D12'] = Value(1)
+    T['D13'] = Value(2)
+    del T['D11']
+    assert T.codeOf(Value(1)) == 'D12'
+    del T['D13']
+    T.alias(Value(2), 'D12')
+    assert T.codeOf(Value(2)) == 'D12'
+    T['D12'] = Value(3)
+    assert T.codeOf(Value(1)) is None and T.codeOf(Value(3)) == 'D12'
+    assert T.newCode() == 'D14'
+
+    # Deleting entries must not compare values with every other entry, or
+    # removing many apertures (e.g., by consolidation) takes quadratic time
+    N = 20000
+    T = CodeTable('D', 11)
+    for n in range(N):
+        T.add(Value(n))
+    Value.compares = 0
+    for n in range(N):
+        if n % 2:
+            del T["D{:d}".format(n + 11)]
+    assert Value.compares <= 2 * N, Value.compares
+    assert len(T) == N // 2 and T.codeOf(Value(2)) == 'D13' and T.codeOf(Value(3)) is None
+
+    print('All tests pass')